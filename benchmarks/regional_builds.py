@@ -0,0 +1,64 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''Measures the throughput of many small regional builds in one warm process,
+sequentially with a reused converter and concurrently in threads and worker processes.
+Every build converts the same cache directory, so all builds must yield the same 
+number of trips, which verifies builds don't share state.
+
+Usage: python benchmarks/regional_builds.py [CACHE_DIR] [BUILDS] [WORKERS]'''
+
+import contextlib, os, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from efa2gtfs.converter import Converter
+
+def build(cache_dir, out_dir, converter = None):
+    if converter is None:
+        converter = Converter()
+    else:
+        converter.reset()
+    converter.import_from_dir(cache_dir, ['vvs'])
+    converter.export_gtfs(out_dir + '/gtfs.zip', out_dir + '/gtfs')
+    return len(converter.gtfs_store.trips)
+
+def silence():
+    # the converter's progress output is not of interest here
+    sys.stdout = open(os.devnull, 'w')
+
+def measure(name, builds, run):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        trip_counts = run()
+    duration = time.perf_counter() - start
+    print('{:<12} {:>4} builds in {:6.2f}s, {:6.1f} builds/s, trips per build: {}'.format(
+        name, builds, duration, builds / duration, sorted(set(trip_counts))))
+
+def main(cache_dir = 'examples/efa_files_cache', builds = 50, workers = 4):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dirs = [os.path.join(tmp_dir, str(idx)) for idx in range(builds)]
+        converter = Converter()
+        measure('sequential', builds, lambda: [build(cache_dir, out_dir, converter) for out_dir in out_dirs])
+        with ThreadPoolExecutor(workers) as executor:
+            measure('threads', builds, lambda: list(executor.map(build, [cache_dir] * builds, out_dirs)))
+        with ProcessPoolExecutor(workers, initializer = silence) as executor:
+            measure('processes', builds, lambda: list(executor.map(build, [cache_dir] * builds, out_dirs)))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*args[:1], *[int(arg) for arg in args[1:3]])
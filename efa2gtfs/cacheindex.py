@@ -0,0 +1,151 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import glob, json, os, sys
+from efa2gtfs import efa
+
+# sidecars don't end with .json, so they are not taken for responses by import_from_dir
+METADATA_SUFFIX = '.meta'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M'
+# days skipped by the crawler as they repeat another day are recorded 
+# in this file, one json record per stop (see EfaCrawler.skip_repeating_days)
+SERVICE_DATE_ALIASES_FILE = 'service_date_aliases.jsonl'
+# pages, bytes and seconds needed to crawl a stop, one json record per crawled stop
+CRAWL_STATS_FILE = 'crawl_stats.jsonl'
+
+def metadata_filename(response_filename):
+    return os.path.splitext(response_filename)[0] + METADATA_SUFFIX
+
+def _lat_lon(coords):
+    if not coords:
+        return None
+    (x, y) = coords.split(',')[:2]
+    (lon, lat) = (float(x) / 1000000.0, float(y) / 1000000.0)
+    # same heuristic as Converter.retrieve_coords, only valid for Germany
+    return [lon, lat] if lon > lat else [lat, lon]
+
+def response_metadata(dm_response, stop_id = None):
+    '''Returns the metadata of the parsed json DM_RESPONSE: stop_id (of the first
+    dm point, if STOP_ID is not provided), coordinates of the dm points, datetimes
+    of the first and last departure, networks and number of departures.'''
+    efa_dm_response = efa.DmResponse(dm_response)
+    points = list(efa_dm_response.points)
+    trips = list(efa_dm_response.trips)
+    datetimes = sorted(trip.scheduled_datetime for trip in trips)
+    if stop_id is None and points:
+        stop_id = points[0].id
+    return {
+        'stop_id': stop_id,
+        'coords': [coords for coords in (_lat_lon(point.coords) for point in points) if coords],
+        'first_departure': datetimes[0].strftime(DATETIME_FORMAT) if datetimes else None,
+        'last_departure': datetimes[-1].strftime(DATETIME_FORMAT) if datetimes else None,
+        'networks': sorted(set(trip.network for trip in trips)),
+        'departures': len(trips),
+    }
+
+def write_metadata(response_filename, dm_response, stop_id = None):
+    metadata = response_metadata(dm_response, stop_id)
+    with open(metadata_filename(response_filename), 'w', encoding='utf-8') as metadata_file:
+        json.dump(metadata, metadata_file)
+    return metadata
+
+def read_metadata(response_filename):
+    '''Returns the metadata of RESPONSE_FILENAME. If it has no sidecar yet, 
+    the response is parsed and the sidecar written. If the sidecar can't be 
+    written (e.g. for a read-only cache), the parsed metadata is returned nonetheless.'''
+    try:
+        with open(metadata_filename(response_filename), 'r', encoding='utf-8') as metadata_file:
+            return json.load(metadata_file)
+    except FileNotFoundError:
+        with open(response_filename, 'r', encoding='utf-8') as response_file:
+            dm_response = json.load(response_file)
+    try:
+        return write_metadata(response_filename, dm_response)
+    except OSError as err:
+        print('WARN: could not write metadata sidecar for {}: {}'.format(response_filename, err))
+        return response_metadata(dm_response)
+
+def index_cache(dir_name, overwrite = False):
+    '''Writes metadata sidecars for all responses in DIR_NAME which have none yet
+    (or for all, if OVERWRITE). Returns the number of written sidecars.'''
+    cnt = 0
+    for fname in glob.iglob(dir_name + '/*.json'):
+        if overwrite or not os.path.exists(metadata_filename(fname)):
+            with open(fname, 'r', encoding='utf-8') as response_file:
+                write_metadata(fname, json.load(response_file))
+            cnt += 1
+    return cnt
+
+def _read_records(filename):
+    try:
+        with open(filename, 'r', encoding='utf-8') as records_file:
+            for line in records_file:
+                if line.strip():
+                    yield json.loads(line)
+    except FileNotFoundError:
+        return
+
+def append_record(filename, record):
+    with open(filename, 'a', encoding='utf-8') as records_file:
+        records_file.write(json.dumps(record) + '\n')
+
+def read_service_date_aliases(dir_name):
+    '''Yields the service date alias records of the cache in DIR_NAME.'''
+    return _read_records(os.path.join(dir_name, SERVICE_DATE_ALIASES_FILE))
+
+def read_crawl_stats(dir_name):
+    '''Yields the crawl stats records (stop_id, pages, bytes, seconds) of the cache in DIR_NAME.'''
+    return _read_records(os.path.join(dir_name, CRAWL_STATS_FILE))
+
+class CacheFilter():
+    '''Selects cached responses by their metadata. BBOX is a tuple (min_lat, min_lon,
+    max_lat, max_lon) which must contain one of the response's dm points, NETWORKS a list
+    of which at least one must be served, START_DATETIME and END_DATETIME limit the time
+    window which must overlap the response's departures. Criteria not provided are ignored.'''
+
+    def __init__(self, bbox = None, networks = None, start_datetime = None, end_datetime = None):
+        self.bbox = bbox
+        self.networks = set(networks) if networks else None
+        self.start = start_datetime.strftime(DATETIME_FORMAT) if start_datetime else None
+        self.end = end_datetime.strftime(DATETIME_FORMAT) if end_datetime else None
+
+    def matches(self, metadata):
+        if self.bbox:
+            (min_lat, min_lon, max_lat, max_lon) = self.bbox
+            if not any(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon for (lat, lon) in metadata['coords']):
+                return False
+        if self.networks is not None and self.networks.isdisjoint(metadata['networks']):
+            return False
+        if self.start or self.end:
+            if not metadata['departures']:
+                return False
+            if self.start and metadata['last_departure'] < self.start:
+                return False
+            if self.end and metadata['first_departure'] > self.end:
+                return False
+        return True
+
+def main(args):
+    if len(args) < 1:
+        print('Usage: python -m efa2gtfs.cacheindex CACHE_DIR')
+        return 1
+    print('Wrote {} metadata files'.format(index_cache(args[0])))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
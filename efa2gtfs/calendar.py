@@ -0,0 +1,118 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+
+class ServiceCalendar():
+    '''Records the service dates every trip was observed on as a bitset
+    (bit n set <=> trip runs on epoch + n days) and derives calendar and
+    calendar_dates entries shared by all trips with the same set of days.'''
+
+    def __init__(self, service_period = None):
+        '''SERVICE_PERIOD is an optional (start_date, end_date) tuple. If not
+        provided, the period is derived from the first and last observed date.'''
+        self.service_period = service_period
+        self._epoch = None
+        self._min_offset = None
+        self._max_offset = None
+        self._trip_days = {}
+
+    def add(self, trip_id, service_date):
+        '''Records that trip TRIP_ID runs on SERVICE_DATE.'''
+        if self._epoch is None:
+            self._epoch = service_date
+            self._min_offset = self._max_offset = 0
+        offset = (service_date - self._epoch).days
+        if offset < 0:
+            self._rebase(-offset)
+            offset = 0
+        self._trip_days[trip_id] = self._trip_days.get(trip_id, 0) | (1 << offset)
+        self._min_offset = min(self._min_offset, offset)
+        self._max_offset = max(self._max_offset, offset)
+
+    def _rebase(self, shift):
+        '''Moves the epoch SHIFT days back, shifting all bitsets accordingly.'''
+        self._epoch -= datetime.timedelta(days=shift)
+        self._min_offset += shift
+        self._max_offset += shift
+        for trip_id in self._trip_days:
+            self._trip_days[trip_id] <<= shift
+
+    def service_dates(self, trip_id):
+        '''Returns the sorted list of dates trip TRIP_ID was observed on.'''
+        days = self._trip_days.get(trip_id, 0)
+        return [self._epoch + datetime.timedelta(days=offset) 
+            for offset in range(days.bit_length()) if days >> offset & 1]
+
+    @property
+    def period(self):
+        if self.service_period:
+            return self.service_period
+        if self._epoch is None:
+            return None
+        return (self._epoch + datetime.timedelta(days=self._min_offset), 
+            self._epoch + datetime.timedelta(days=self._max_offset))
+
+    def derive(self, trip_ids = None):
+        '''Groups trips (restricted to TRIP_IDS, if provided) with identical service days 
+        and returns a tuple (service_id by trip_id, calendar rows by service_id, calendar_dates rows).
+        Weekdays are set in calendar if the trip runs on the majority of 
+        these weekdays within the period, deviating days are added as calendar_dates.
+        Trips not running on any day within the period get no service_id.'''
+        if self._epoch is None:
+            return {}, {}, []
+        (start_date, end_date) = self.period
+        first = (start_date - self._epoch).days
+        day_count = (end_date - start_date).days + 1
+        period_mask = (1 << day_count) - 1
+        
+        trip_masks = {}
+        for trip_id, days in self._trip_days.items():
+            if trip_ids is not None and not trip_id in trip_ids:
+                continue
+            mask = (days >> first if first >= 0 else days << -first) & period_mask
+            if mask:
+                trip_masks[trip_id] = mask
+        
+        # most frequent day patterns first, so service_ids are stable for a given input
+        masks = sorted(set(trip_masks.values()), key = lambda mask: (-bin(mask).count('1'), mask))
+        service_id_by_mask = {mask: str(idx + 1) for idx, mask in enumerate(masks)}
+        
+        dates = [start_date + datetime.timedelta(days=offset) for offset in range(day_count)]
+        calendar = {}
+        calendar_dates = []
+        for mask in masks:
+            service_id = service_id_by_mask[mask]
+            weekdays = self._weekday_flags(mask, dates)
+            calendar[service_id] = [service_id, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'), *weekdays]
+            for offset, date in enumerate(dates):
+                runs = mask >> offset & 1
+                if runs != weekdays[date.weekday()]:
+                    # exception_type 1: service added, 2: service removed
+                    calendar_dates.append([date.strftime('%Y%m%d'), service_id, '1' if runs else '2'])
+        
+        service_ids = {trip_id: service_id_by_mask[mask] for trip_id, mask in trip_masks.items()}
+        return service_ids, calendar, calendar_dates
+
+    def _weekday_flags(self, mask, dates):
+        active = [0] * 7
+        total = [0] * 7
+        for offset, date in enumerate(dates):
+            total[date.weekday()] += 1
+            active[date.weekday()] += mask >> offset & 1
+        return [1 if active[weekday] * 2 > total[weekday] else 0 for weekday in range(7)]
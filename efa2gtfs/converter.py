@@ -16,64 +16,132 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import json, glob
+import datetime, json, glob
 import traceback
 import itertools
 import os
 from efa2gtfs import util
 from efa2gtfs.store import GtfsStore
+from efa2gtfs.spatial import StopLocator
 from efa2gtfs import efa
+from efa2gtfs import cacheindex
 
 class Converter():
-    agencies = {}
-    current_file = ''
-    agency_counter = 0
-    agencies_to_ignore = []
-    gtfs_store = GtfsStore()
     
-    pointGids_ok = {}
-    pointGids_not_ok = {}
-    fixed_coords = {}
-    fix_stop_id_in_trip = {}
-    # Workaround for corrupted data. For one route, we want to ignore some out of sequence stops
-    stops_to_ignore= {}
-    route_to_fix_stop_times = {}
+    def __init__(self, gtfs_store = None):
+        self.gtfs_store = gtfs_store if gtfs_store is not None else GtfsStore()
+        self.pointGids_ok = {}
+        self.pointGids_not_ok = {}
+        self.fixed_coords = {}
+        self.fix_stop_id_in_trip = {}
+        # Workaround for corrupted data. For one route, we want to ignore some out of sequence stops
+        self.stops_to_ignore= {}
+        self.route_to_fix_stop_times = {}
+        # (start_date, end_date) of the crawled period. If None, it's derived from the observed service dates
+        self.service_period = None
+        self.reset()
     
-    def export_gtfs(self, gtfs_filename, out_dir_name):
+    def reset(self):
+        '''Discards all extracted data, so the converter can be reused for another feed.
+        Configured fixes (fixed_coords, stops_to_ignore etc.) are kept.'''
+        self.agencies = {}
+        self.current_file = ''
+        self.agency_counter = 0
+        self.agencies_to_ignore = []
+        # trip_id => {stop_id: pointGid based stop_id}, see resolve_point_gids
+        self.point_gid_candidates = {}
+        # stop_id => (start of crawled days, {day: [days skipped as repeating it]})
+        self.service_date_aliases = {}
+        # efa trip_id => [(timetable, trip_id)] per variant with different running times, see trip_variant_id
+        self.trip_variants = {}
+        self.gtfs_store.reset()
+    
+    def export_gtfs(self, gtfs_filename, out_dir_name, frequencies = False, strict = False, sqlite_filename = None, transfers = False):
+        '''Exports the extracted data as gtfs to OUT_DIR_NAME and zips it as GTFS_FILENAME.
+        If FREQUENCIES is True, trips running at regular headways are exported via frequencies.txt.
+        If STRICT, export fails with a validator.FeedValidationError if the feed has errors.
+        If SQLITE_FILENAME is provided, the feed is additionally written to an indexed sqlite database.
+        If TRANSFERS is True, walking transfers between nearby stops are exported (see spatial.TransferBuilder).'''
         if not os.path.exists(out_dir_name): os.makedirs(out_dir_name)
-        self.gtfs_store.export(gtfs_filename, out_dir_name)
+        self.resolve_point_gids()
+        stop_locator = StopLocator(self.gtfs_store)
+        stop_locator.check_coordinates()
+        stop_locator.cluster_stations()
+        self.gtfs_store.export(gtfs_filename, out_dir_name, frequencies, strict, sqlite_filename, transfers)
     
-    def import_from_dir(self, dir_name, agencies_to_ignore = None):
+    def import_from_dir(self, dir_name, agencies_to_ignore = None, cache_filter = None):
         '''Iterates over all *.json files in DIR_NAME. The json file is assumed to be
-        in DM-Request response format and to contain service lines.'''
-        
-        self.gtfs_store.init_static_content()
+        in DM-Request response format and to contain service lines. If a 
+        cacheindex.CacheFilter CACHE_FILTER is provided, only files whose metadata
+        sidecar matches are imported.'''
         
-        if agencies_to_ignore:
-            self.agencies_to_ignore += agencies_to_ignore
+        self.prepare_import(agencies_to_ignore)
+        for record in cacheindex.read_service_date_aliases(dir_name):
+            self.add_service_date_aliases(record)
         
         pattern = dir_name+'/*.json'
         cnt = 0
+        skipped = 0
         for fname in glob.iglob(pattern):
             try:
+                if cache_filter and not cache_filter.matches(cacheindex.read_metadata(fname)):
+                    skipped += 1
+                    continue
                 cnt += 1
                 print('Load ', fname, '(', cnt,'/?)')
                 self.extract_gtfs_info_from_dm_response_file(fname)
             except Exception as err:
                 traceback.print_exc()
-        self.gtfs_store.filter_unused_stops()
+        if cache_filter:
+            print('Skipped {} files not matching the cache filter'.format(skipped))
+        self.resolve_point_gids()
+    
+    def prepare_import(self, agencies_to_ignore = None):
+        '''Initializes the static gtfs content and registers AGENCIES_TO_IGNORE.
+        Needs to be called before responses are extracted.'''
+        self.gtfs_store.init_static_content(self.service_period)
+        
+        if agencies_to_ignore:
+            self.agencies_to_ignore += agencies_to_ignore
                 
+    def add_service_date_aliases(self, record):
+        '''Registers the days the crawler skipped for a stop, as they repeated another day.
+        Trips departing at this stop on the other day are assumed to run on the skipped days, too.'''
+        (hour, minute) = record['day_start'].split(':')
+        day_start = datetime.timedelta(hours = int(hour), minutes = int(minute))
+        aliases = self.service_date_aliases.setdefault(record['stop_id'], (day_start, {}))[1]
+        for alias_day, day in record['aliases'].items():
+            aliases.setdefault(day, []).append(datetime.datetime.strptime(alias_day, '%Y%m%d').date())
+    
+    def alias_service_dates(self, trip):
+        '''Returns the service dates TRIP runs on additionally, as the day of its
+        departure at the current stop was repeated on days skipped by the crawler.'''
+        if not trip.stop_id in self.service_date_aliases:
+            return []
+        (day_start, aliases) = self.service_date_aliases[trip.stop_id]
+        day = (trip.scheduled_datetime - day_start).date()
+        alias_days = aliases.get(day.strftime('%Y%m%d'))
+        if not alias_days:
+            return []
+        service_date = trip.service_date
+        return [service_date + (alias_day - day) for alias_day in alias_days]
+    
     def extract_gtfs_info_from_dm_response_file(self, fname):
         with open(fname, "r", encoding="utf-8") as f:
-            self.current_file = fname
             content = f.read()
             dm_response = json.loads(content)
-            efa_dm_response = efa.DmResponse(dm_response) 
-            try:
-                self.extract_gtfs_info_from_dm_response(efa_dm_response)
-            except (TypeError, ValueError, KeyError) as err:
-                print("Uncaught exception parsing file ", fname)
-                raise
+            self.extract_gtfs_info_from_json(dm_response, fname)
+    
+    def extract_gtfs_info_from_json(self, dm_response, fname):
+        '''Extracts gtfs info from the parsed json DM_RESPONSE. FNAME is 
+        used as source for the extracted entities.'''
+        self.current_file = fname
+        efa_dm_response = efa.DmResponse(dm_response) 
+        try:
+            self.extract_gtfs_info_from_dm_response(efa_dm_response)
+        except (TypeError, ValueError, KeyError) as err:
+            print("Uncaught exception parsing file ", fname)
+            raise
                 
     def extract_gtfs_info_from_dm_response(self, dm_response):
         '''Extracts stop, route, trip and stop_time information from DM_RESPONSE
@@ -81,8 +149,9 @@ class Converter():
         self.gtfs_store.cache(self.process_stop_via_points(dm_response), self.gtfs_store.stops)
         self.gtfs_store.cache(self.process_stops_via_stop_sequences(dm_response).values(), self.gtfs_store.stops)
         self.gtfs_store.cache(self.process_routes(dm_response), self.gtfs_store.routes)
-        self.gtfs_store.cache(self.process_trips(dm_response), self.gtfs_store.trips)
-        self.gtfs_store.cache(self.process_stop_times(dm_response), self.gtfs_store.stop_times, 2)
+        sightings = self.process_sightings(dm_response)
+        self.gtfs_store.cache(self.process_trips(sightings), self.gtfs_store.trips)
+        self.gtfs_store.cache_stop_times(self.process_stop_times(sightings))
    
     # ---- 1 --------------------------------------------------
     def process_stop_via_points(self, efa_dm_response):
@@ -183,10 +252,8 @@ class Converter():
                 
     def _should_ignore(self, network, route_type):
         '''Ignore routes/trips/stoptimes for routes from agencies
-        which should be ignored AND are not ON DEMAND 
-        (type 715), as this seems not to be published in GTFS 
-        currently, but we are interested in...'''     
-        return network in self.agencies_to_ignore and route_type != 715
+        which should be ignored (see efa.is_ignored)'''     
+        return efa.is_ignored(network, route_type, self.agencies_to_ignore)
 
     # ---- 3 --------------------------------------------------
     def process_routes(self, efa_dm_response):
@@ -254,15 +321,57 @@ class Converter():
         return out_routes
         
     # ---- 4 --------------------------------------------------
-    def process_trips(self, efa_dm_response):
+    def process_sightings(self, efa_dm_response):
+        '''Returns (trip, trip_id, stop_times) for every trip of EFA_DM_RESPONSE. 
+        Trips with the same efa trip_id but different running times get different 
+        trip_ids (see trip_variant_id).'''
+        sightings = []
+        for trip in self.filtered_trips(efa_dm_response):
+            stop_times = self.build_stop_times(trip)
+            trip_id = self.trip_variant_id(trip.trip_id, stop_times)
+            if trip_id != trip.trip_id:
+                for stop_time in stop_times:
+                    stop_time[GtfsStore.STOP_TIME_TRIP_ID_IDX] = trip_id
+            sightings.append((trip, trip_id, stop_times))
+        return sightings
+    
+    def trip_variant_id(self, efa_trip_id, stop_times, register = True):
+        '''Returns the trip_id for a sighting of trip EFA_TRIP_ID with STOP_TIMES. 
+        As the service days are not part of the efa trip_id, e.g. a saturday trip may 
+        share it with a weekday trip running at different times. Such a trip becomes a 
+        separate trip, whose trip_id is suffixed by a variant number. If REGISTER is False,
+        unknown variants are not recorded and EFA_TRIP_ID is returned for them.'''
+        timetable = tuple((stop_time[GtfsStore.STOP_TIME_SEQ_NR], stop_time[2], stop_time[3]) for stop_time in stop_times)
+        variants = self.trip_variants.get(efa_trip_id, [])
+        for (variant_timetable, trip_id) in variants:
+            if variant_timetable == timetable:
+                return trip_id
+        if not register:
+            return efa_trip_id
+        if not variants:
+            self.trip_variants[efa_trip_id] = variants
+            trip_id = efa_trip_id
+        else:
+            trip_id = '{}-{}'.format(efa_trip_id, len(variants) + 1)
+            print('WARN: trip {} runs at different times than {}, stored as separate trip, file {}'.format(
+                trip_id, efa_trip_id, self.current_file))
+        variants.append((timetable, trip_id))
+        return trip_id
+    
+    def process_trips(self, sightings):
+        '''Returns a trip row for every sighting of SIGHTINGS (see process_sightings)
+        and records its service dates.'''
         out_trips = []
 
         #trip_id,route_id,service_id,trip_headsign
-        for trip in self.filtered_trips(efa_dm_response):        
+        for (trip, trip_id, stop_times) in sightings:
+            self.gtfs_store.add_service_date(trip_id, trip.service_date)
+            for service_date in self.alias_service_dates(trip):
+                self.gtfs_store.add_service_date(trip_id, service_date)
             row = [
-              trip.trip_id,
+              trip_id,
               trip.route_id,
-              trip.service_id, 
+              '', # service_id is derived from all service dates on export
               trip.direction
             ]
             out_trips.append(row)
@@ -270,10 +379,16 @@ class Converter():
         return out_trips
 
     # ---- 5 --------------------------------------------------
-    def process_stop_times(self, efa_dm_response):
+    def process_stop_times(self, sightings):
+        '''Returns a list of stop_times per not yet extracted trip of SIGHTINGS (see process_sightings).'''
         out_stop_times = []
-        for trip in self.filtered_trips(efa_dm_response):    
-            out_stop_times.extend(self.process_stop_times_for_trip(trip))
+        for (trip, trip_id, stop_times) in sightings:
+            # we process trip only if was not processed yet, to avoid gtfs issues due to efa inconsistencies
+            if self.gtfs_store.is_stop_times_extracted(trip_id):
+                # but a stop_time might not yet have a stop_id derived from pointGid
+                self.record_point_gid_candidates(trip_id, trip)
+            else:
+                out_stop_times.append(stop_times)
         
         return out_stop_times
 
@@ -289,42 +404,41 @@ class Converter():
             if not self._should_ignore(network, trip.route_type):            
                 yield trip, network, route_type_and_colors
     
-    def update_point_gid_for_stop(self, stop, prevStops, onwardStops):
-        for trip_stop in itertools.chain(prevStops, onwardStops):
-            # we replace to stop id with the stateless id of the first prev/onward stop with the same id
-            if trip_stop.id == stop[4] and trip_stop.point_gid:
-                self.gtfs_store.update_stop_id(stop, self.retrieve_stop_id(trip_stop))
-                return 
+    def record_point_gid_candidates(self, trip_id, trip):
+        '''Records, for every stop_id of the already extracted trip TRIP_ID which is not a 
+        pointGid yet, the stateless id of the first prev/onward stop of TRIP with the same id.
+        Only the first candidate per stop is kept, they are applied by resolve_point_gids.'''
+        unresolved = self.gtfs_store.unresolved_stop_ids(trip_id)
+        if not unresolved:
+            return
+        candidates = self.point_gid_candidates.setdefault(trip_id, {})
+        if len(candidates) == len(unresolved):
+            return
+        for trip_stop in itertools.chain(trip.prev_stops, trip.onward_stops):
+            stop_id = trip_stop.id
+            if stop_id in unresolved and not stop_id in candidates and trip_stop.point_gid:
+                candidates[stop_id] = self.retrieve_stop_id(trip_stop)
     
-    def update_point_gid(self, trip_id, trip):
-        stops_without_point_gid = self.gtfs_store.stops_without_point_gid(trip_id)
-        for stop in stops_without_point_gid:
-            self.update_point_gid_for_stop(stop, trip.prev_stops, trip.onward_stops)
+    def resolve_point_gids(self):
+        '''Replaces stop_ids by the pointGid based ids recorded while importing. 
+        Every affected trip is updated once.'''
+        for trip_id, candidates in self.point_gid_candidates.items():
+            if candidates:
+                self.gtfs_store.update_stop_ids(trip_id, candidates)
+        self.point_gid_candidates = {}
     
-    def process_stop_times_for_trip(self, trip):
+    def build_stop_times(self, trip):
+        '''Returns the stop_times of TRIP, using its efa trip_id.'''
         trip_id = trip.trip_id
-        
-        # we process trip only if was not processed yet, to avoid gtfs issues due to efa inconsistencies
-        if self.gtfs_store.is_stop_times_extracted(trip_id):
-            # but we need to reprocess a trip, since a stop_time might not yet have a stop_id derived from pointGid
-            self.update_point_gid(trip_id, trip)
-            return []
-        
         start_hour_int = trip.start_hour
         is_on_demand_trip = trip.is_on_demand_trip
         
-        prev_stops = trip.prev_stops
-        onward_stops = trip.onward_stops
-        prev_stop_times = self.process_stop_seq_times(prev_stops, trip_id, 0, start_hour_int,is_on_demand_trip)
-        
-        # sometimes current stop is already contained in prevStops or is the first of the onwardStops. Probably if multiple platforms are served. TODO: there is no pointGid for current stop, but probably area/platform? 
-        if not (prev_stops and trip.stop_id == prev_stops[-1].id) and not (onward_stops and trip.stop_id == onward_stops[0].id):
-            current_stop_time = self.process_current_stop_time(trip, trip_id, len(prev_stop_times), start_hour_int, is_on_demand_trip)
-            prev_stop_times.append(current_stop_time)
-        
-        onward_stop_times = self.process_stop_seq_times(onward_stops, trip_id, len(prev_stop_times), start_hour_int, is_on_demand_trip)
-        
-        stop_times = prev_stop_times + onward_stop_times
+        stop_times = []
+        for (stop_sequence, stop_id, stop) in self.trip_stops(trip):
+            if stop is None:
+                stop_times.append(self.process_current_stop_time(trip, trip_id, stop_id, stop_sequence, is_on_demand_trip))
+            else:
+                stop_times.append(self.process_stop_time(stop, trip_id, stop_id, stop_sequence, start_hour_int, is_on_demand_trip))
         route_id = trip.route_id
         if route_id in self.route_to_fix_stop_times:
             stop_times = self.fix_stop_times_order(stop_times)
@@ -340,19 +454,38 @@ class Converter():
         return sorted_stop_times
 
     
-    def process_current_stop_time(self, trip, trip_id, previous_stop_sequence,start_hour_int, is_on_demand_trip):
+    def trip_stops(self, trip):
+        '''Returns (stop_sequence, stop_id, stop) for every stop of TRIP, which becomes a stop_time.
+        For the current stop, stop is None. Used for static stop_times and realtime updates alike.'''
+        trip_id = trip.trip_id
+        prev_stops = trip.prev_stops
+        onward_stops = trip.onward_stops
+        trip_stops = self._stop_seq_ids(prev_stops, trip_id)
+        
+        # sometimes current stop is already contained in prevStops or is the first of the onwardStops. Probably if multiple platforms are served. TODO: there is no pointGid for current stop, but probably area/platform? 
+        if not (prev_stops and trip.stop_id == prev_stops[-1].id) and not (onward_stops and trip.stop_id == onward_stops[0].id):
+            current_stop_id = self._current_stop_id(trip, trip_id)
+            if current_stop_id:
+                trip_stops.append((current_stop_id, None))
+        
+        trip_stops += self._stop_seq_ids(onward_stops, trip_id)
+        return [(stop_sequence, stop_id, stop) for stop_sequence, (stop_id, stop) in enumerate(trip_stops, 1)]
+    
+    def _current_stop_id(self, trip, trip_id):
         route_id = trip.route_id
         stop_id = trip.stop_id
         if route_id in self.fix_stop_id_in_trip and stop_id in self.fix_stop_id_in_trip[route_id]:
             stop_id = self.fix_stop_id_in_trip[route_id][stop_id]
         if self._should_ignore_stop(trip_id, stop_id):
-            return []
-        
+            return None
+        return stop_id
+    
+    def process_current_stop_time(self, trip, trip_id, stop_id, stop_sequence, is_on_demand_trip):
         current_stop_time = trip.stop_time
         
         return [
             trip_id,
-            previous_stop_sequence + 1,
+            stop_sequence,
             current_stop_time,
             current_stop_time,
             stop_id,
@@ -372,8 +505,9 @@ class Converter():
             return True
         return False
         
-    def process_stop_seq_times(self, stop_seq, trip_id, stop_sequence, start_hour_int, is_on_demand_trip):
-        out_stop_times = []
+    def _stop_seq_ids(self, stop_seq, trip_id):
+        '''Returns (stop_id, stop) for the stops of STOP_SEQ which become stop_times.'''
+        stop_ids = []
         
         prevStopId = None
         for stop in stop_seq:
@@ -392,25 +526,25 @@ class Converter():
                 stop_stateless_id = self.fix_stop_id_in_trip[route_id][stop_stateless_id]
                  
             prevStopId = stop_id    
-            stop_sequence += 1
-            
-            arrDateTime = stop.arrival_date_time
-            depDateTime = stop.departure_date_time
-            #trip_id,stop_sequence,arrival_time,departure_time,stop_id,stop_headsign,pickup_type,drop_off_type,source
-            row = [
-                trip_id,
-                stop_sequence,
-                util.convert_to_gtfs_time(*(arrDateTime.split(' ')[1].split(':')), start_hour_int)+ ':00',
-                util.convert_to_gtfs_time(*(depDateTime.split(' ')[1].split(':')), start_hour_int)+ ':00',
-                stop_stateless_id,
-                '', # no headsign
-                2 if is_on_demand_trip else 0,
-                2 if is_on_demand_trip else 0,
-                self.current_file[-20:], # insert filename for debugging purposes
-                ]
-            out_stop_times.append(row)
+            stop_ids.append((stop_stateless_id, stop))
             
-        return out_stop_times
+        return stop_ids
+    
+    def process_stop_time(self, stop, trip_id, stop_id, stop_sequence, start_hour_int, is_on_demand_trip):
+        arrDateTime = stop.arrival_date_time
+        depDateTime = stop.departure_date_time
+        #trip_id,stop_sequence,arrival_time,departure_time,stop_id,stop_headsign,pickup_type,drop_off_type,source
+        return [
+            trip_id,
+            stop_sequence,
+            util.convert_to_gtfs_time(*(arrDateTime.split(' ')[1].split(':')), start_hour_int)+ ':00',
+            util.convert_to_gtfs_time(*(depDateTime.split(' ')[1].split(':')), start_hour_int)+ ':00',
+            stop_id,
+            '', # no headsign
+            2 if is_on_demand_trip else 0,
+            2 if is_on_demand_trip else 0,
+            self.current_file[-20:], # insert filename for debugging purposes
+            ]
 
     def retrieve_agency_id(self, network):
         '''Maps the network name to an already asigned agency_id
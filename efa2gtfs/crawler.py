@@ -16,26 +16,69 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import configparser, requests, datetime, time, os, json
+import configparser, requests, datetime, time, os, json, socket
+import email.utils
 
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
+from efa2gtfs.throttle import AdaptiveThrottle, CircuitBreaker
+from efa2gtfs.workqueue import LeaseLostError
+from efa2gtfs import cacheindex, efa, util
+
+# http status returned by servers asking for fewer requests
+TOO_MANY_REQUESTS = 429
+
+# stops served only by ignored networks are recorded in this file (in data_dir, 
+# if not configured otherwise via IgnoredStopsFile) and skipped by later crawls
+IGNORED_STOPS_FILE = 'ignored_stops.txt'
 
 
 
 class EfaCrawler():
 
-    def __init__(self, config_file = 'config.ini', config_section = 'default'):
+    def __init__(self, config_file = 'config.ini', config_section = 'default', agencies_to_ignore = None):
+        '''Departures of AGENCIES_TO_IGNORE (or configured AgenciesToIgnore) are dropped
+        before responses are saved, with the same exception for on demand services
+        as applied by the converter (see efa.is_ignored).'''
         self._config = config = configparser.ConfigParser()
         self._config.read(config_file)
         self._config_section = config_section
         self._session = requests.Session()
+        if agencies_to_ignore is None:
+            agencies_to_ignore = [network.strip() for network in 
+                self._config.get(config_section, 'AgenciesToIgnore', fallback = '').split(',') if network.strip()]
+        self.agencies_to_ignore = agencies_to_ignore
+        self._stops_to_skip = set()
+        # pages, bytes and seconds of request latency of the current stop, recorded as crawl stats
+        self._stop_pages = 0
+        self._stop_bytes = 0
+        self._stop_latency = 0
 
-        retries = Retry(total=10,
-                backoff_factor=0.1,
-                status_forcelist=[ 500, 502, 503, 504 ])
+        # urllib3 does not retry: connection errors, timeouts and server errors are all
+        # retried by _request, so every attempt is paced by the throttle and counted by the circuit breaker
+        retries = Retry(total=0)
 
         self._session.mount('http://', HTTPAdapter(max_retries=retries))
+        self._session.mount('https://', HTTPAdapter(max_retries=retries))
+        
+        # stalled requests are given up after this many seconds and count as failures
+        self._request_timeout = self._get_float('RequestTimeout', 10 * self._get_float('TargetLatency', 2.0))
+        self._throttle = AdaptiveThrottle(
+            1.0 / self.sleep_interval if self.sleep_interval > 0 else self._get_float('MaxRequestsPerSecond', 10), 
+            min_rate = self._get_float('MinRequestsPerSecond', 0.1),
+            max_rate = self._get_float('MaxRequestsPerSecond', 10),
+            target_latency = self._get_float('TargetLatency', 2.0))
+        self._circuit_breaker = CircuitBreaker(
+            int(self._get_float('CircuitBreakerThreshold', 5)),
+            self._get_float('CircuitBreakerCooldown', 60))
+
+    def _get_float(self, option, fallback):
+        return float(self._config.get(self._config_section, option, fallback = fallback))
+
+    @property
+    def current_rate(self):
+        '''The current request rate (requests per second), adapted to EFA's response latency.'''
+        return self._throttle.current_rate
 
     @property
     def skip_until_stop(self):
@@ -52,12 +95,20 @@ class EfaCrawler():
     @property
     def stops_file(self):
         return self._config.get(self._config_section,'StopsFile')
+
+    @property
+    def ignored_stops_file(self):
+        return self._config.get(self._config_section, 'IgnoredStopsFile', fallback = None)
+
+    @property
+    def skip_repeating_days(self):
+        return self._config.getboolean(self._config_section, 'SkipRepeatingDays', fallback = False)
         
 
     def _save(self, result_file_name, response):
         with open(result_file_name, "w", encoding="utf-8" ) as result_file:
             result_file.write(json.dumps(response, sort_keys = False, indent = 2))
-        print("Wrote {}".format(result_file_name))
+        print("Wrote {} (rate {:.2f} req/s)".format(result_file_name, self.current_rate))
 
     def _as_idt_date_time(self, a_datetime):
         return (a_datetime.strftime('%y%m%d'),
@@ -80,7 +131,7 @@ class EfaCrawler():
             int(dt['hour']),
             int(dt['minute'])) 
 
-    def _get_route(self, baseurl,id, itd_date, itd_time):
+    def _get_route(self, baseurl,id, itd_date, itd_time, use_realtime = False):
 
         payload = {
             'locationServerActive': '1',
@@ -118,12 +169,59 @@ class EfaCrawler():
             #'snapHouseNum': '1'
             
         }
+        if use_realtime:
+            payload['useRealtime'] = '1'
         # http://www.efa-bw.de/nvbw/XML_DM_REQUEST?locationServerActive=1&appCache=true&googleAnalytics=false&type_dm=stop&limit=999999&outputFormat=JSON&coordOutputFormat=WGS84&language=de&depType=stopEvents&mode=direct&includeCompleteStopSeq=1&name_dm=2506793&itdDate=20180611&itdTime=1752
-        response = self._session.get(baseurl + 'XML_DM_REQUEST', params=payload)
+        response = self._request(baseurl + 'XML_DM_REQUEST', payload)
         response.encoding='utf-8'
+        self._stop_pages += 1
+        self._stop_bytes += len(response.content)
         
         return response.json()
 
+    def _request(self, url, payload, max_retries = 10):
+        '''Performs a GET request paced by the adaptive throttle. Server errors (5xx), 429 Too Many
+        Requests, connection errors and timeouts are retried up to MAX_RETRIES times, repeated errors 
+        open the circuit breaker, which pauses requests. A Retry-After header delays the next request.'''
+        for attempt in range(max_retries + 1):
+            self._circuit_breaker.wait_until_closed()
+            self._throttle.wait()
+            start = time.monotonic()
+            try:
+                response = self._session.get(url, params=payload, timeout=self._request_timeout)
+                success = response.status_code < 500 and response.status_code != TOO_MANY_REQUESTS
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                response = None
+                success = False
+            latency = time.monotonic() - start
+            self._throttle.record(latency, success)
+            self._circuit_breaker.record(success)
+            if success:
+                self._stop_latency += latency
+                return response
+            retry_after = self._retry_after(response)
+            if retry_after:
+                self._throttle.defer(retry_after)
+            print("Request failed ({}), retrying with rate {:.2f} req/s".format(
+                response.status_code if response is not None else 'connection error or timeout', self.current_rate))
+        if response is None:
+            raise requests.exceptions.ConnectionError("Giving up after {} retries".format(max_retries))
+        response.raise_for_status()
+
+    def _retry_after(self, response):
+        '''Returns the seconds to wait according to the Retry-After header of RESPONSE
+        (given as seconds or http date) or None, if it has none.'''
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if not retry_after:
+            return None
+        if retry_after.strip().isdigit():
+            return int(retry_after)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max((retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds(), 0)
+
     def stops_from_file(self, fname, skip_until_stop_id = None):
         '''A generator function returning all stop_ids from a csv file whose first column is the stop_id.
         If skip_until_stop_id is provided, all stop_ids are skipped until the first time a stop_id of the given value is encountered.'''
@@ -137,38 +235,249 @@ class EfaCrawler():
                 skip_until_stop_id = None
                 yield stop_id
 
-    def load_trips_between(self, start_datetime, end_datetime, data_dir, stops_generator = None):
-        '''For every stop_id returned by the provided stops_generator (or configured StopsFile), all departures for the period between start_datetime and end_datetime are retrieved and cached json files in data_dir.'''
+    def load_trips_between(self, start_datetime, end_datetime, data_dir, stops_generator = None, response_queue = None):
+        '''For every stop_id returned by the provided stops_generator (or configured StopsFile), all departures for the period between start_datetime and end_datetime are retrieved and cached as json files in data_dir.
+        If a response_queue is provided, every response is additionally put into this queue as (file_name, response) tuple, blocking while the queue is full. If data_dir is None, responses are not cached.'''
         if not stops_generator:
             stops_generator = self.stops_from_file(self.stops_file, self.skip_until_stop)
 
-        if not os.path.exists(data_dir): os.makedirs(data_dir)
+        if data_dir and not os.path.exists(data_dir): os.makedirs(data_dir)
+        self._load_ignored_stops(data_dir)
 
         for stop_id in stops_generator:
+            if stop_id in self._stops_to_skip:
+                print('Skipped {}, as it is served by ignored networks only'.format(stop_id))
+                continue
             try:
-                counter = 1
-                (itd_date, itd_time) = self._as_idt_date_time(start_datetime)
-                former_last_dep_datetime = None
-                while True:
-                    response = self._get_route(self.efa_base_url, int(stop_id), itd_date, itd_time) 
-                    result_file_name = data_dir+"/"+stop_id+"_"+str(counter)+".json"
-                    self._save(result_file_name, response)
-                    time.sleep(self.sleep_interval)
-                    
-                    last_dep_datetime = self._get_max_dep_datetime(response)
-                    # if results past intended range were returned or no new departures returned for this stop, leave
-                    if last_dep_datetime is not None and last_dep_datetime > end_datetime:
-                        break
-                    elif (last_dep_datetime is None or former_last_dep_datetime == last_dep_datetime):
-                        # FIXME if efa only returns next 24h and this day is not served, we should
-                        # increment by 24h
-                        break
-                    else:
-                        # otherwise increment date/time and request again
-                        (itd_date, itd_time) = self._as_idt_date_time(last_dep_datetime)
-                        counter += 1
-                        former_last_dep_datetime = last_dep_datetime
-                        
+                self._load_trips_for_stop(stop_id, start_datetime, end_datetime, data_dir, response_queue)
             except ValueError as err:
                 print ("\nValue Error! " + str(stop_id) + str(err))
+            except requests.exceptions.RequestException as err:
+                print ("\nRequest Error! " + str(stop_id) + str(err))
+
+    def load_trips_from_queue(self, work_queue, data_dir, worker = None, response_queue = None):
+        '''Leases (stop_id, time window) units from WORK_QUEUE (see workqueue.CrawlWorkQueue) 
+        for this crawler's config section and retrieves their departures as load_trips_between 
+        does, until no unit is left. The lease is renewed after every response. If it was lost
+        to another worker meanwhile, the unit is left to this worker and the next one is leased.'''
+        if not worker:
+            worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+        if data_dir and not os.path.exists(data_dir): os.makedirs(data_dir)
+        self._load_ignored_stops(data_dir)
+        
+        while True:
+            unit = work_queue.lease(worker, self._config_section)
+            if unit is None:
+                break
+            (unit_id, stop_id, start_datetime, end_datetime) = unit
+            if stop_id in self._stops_to_skip:
+                work_queue.complete(unit_id, worker)
+                continue
+            def renew_lease():
+                if not work_queue.renew(unit_id, worker):
+                    raise LeaseLostError('Lease of unit {} (stop {}) was lost'.format(unit_id, stop_id))
+            try:
+                self._load_trips_for_stop(stop_id, start_datetime, end_datetime, data_dir, response_queue, renew_lease)
+                work_queue.complete(unit_id, worker)
+            except LeaseLostError as err:
+                print(err)
+            except (ValueError, requests.exceptions.RequestException) as err:
+                print ("\nError loading stop " + str(stop_id) + ": " + str(err))
+                work_queue.fail(unit_id, worker)
+
+    def _ignored_stops_filename(self, data_dir):
+        if self.ignored_stops_file:
+            return self.ignored_stops_file
+        return os.path.join(data_dir, IGNORED_STOPS_FILE) if data_dir else None
+
+    def _load_ignored_stops(self, data_dir):
+        '''Reads the stops learned to be served by ignored networks only. Stops
+        served by a network which is not ignored anymore will be crawled again.'''
+        filename = self._ignored_stops_filename(data_dir)
+        if not self.agencies_to_ignore or not filename or not os.path.exists(filename):
+            return
+        with open(filename, "r", encoding="utf-8") as f:
+            for line in f:
+                (stop_id, _, networks) = line.strip().partition(',')
+                if stop_id and set(networks.split(' ')).issubset(self.agencies_to_ignore):
+                    self._stops_to_skip.add(stop_id)
+
+    def _learn_ignored_stop(self, stop_id, networks, data_dir):
+        self._stops_to_skip.add(stop_id)
+        filename = self._ignored_stops_filename(data_dir)
+        if filename:
+            with open(filename, "a", encoding="utf-8") as f:
+                f.write('{},{}\n'.format(stop_id, ' '.join(sorted(networks))))
+        print('Stop {} is served by ignored networks only and will be skipped next time'.format(stop_id))
+
+    def _filter_departures(self, response):
+        '''Drops the departures of ignored networks from RESPONSE and records
+        the networks serving the current stop.'''
+        if not response.get('departureList'):
+            return
+        departures = util.as_array(response, 'departureList')
+        kept_departures = []
+        for departure in departures:
+            trip = efa.DmDeparture(departure)
+            self._stop_networks.add(trip.network)
+            if not trip.is_ignored(self.agencies_to_ignore):
+                kept_departures.append(departure)
+        self._kept_departures += len(kept_departures)
+        if len(kept_departures) < len(departures):
+            response['departureList'] = kept_departures
+
+    def _load_trips_for_stop(self, stop_id, start_datetime, end_datetime, data_dir, response_queue = None, on_response = None):
+        self._stop_networks = set()
+        self._kept_departures = 0
+        self._stop_pages = 0
+        self._stop_bytes = 0
+        self._stop_latency = 0
+        if self.skip_repeating_days:
+            self._load_distinct_days_for_stop(stop_id, start_datetime, end_datetime, data_dir, response_queue, on_response)
+        else:
+            self._load_pages(stop_id, start_datetime, end_datetime, data_dir, response_queue, on_response)
+        if data_dir:
+            # used by scheduler.CrawlCostEstimator to schedule the next crawl. Only the latency 
+            # of successful requests is recorded, not the time spent in throttle or circuit breaker
+            cacheindex.append_record(os.path.join(data_dir, cacheindex.CRAWL_STATS_FILE), {'stop_id': stop_id, 
+                'pages': self._stop_pages, 'bytes': self._stop_bytes, 'seconds': round(self._stop_latency, 3)})
+        if self.agencies_to_ignore and self._stop_networks and self._kept_departures == 0:
+            self._learn_ignored_stop(stop_id, self._stop_networks, data_dir)
+
+    def _load_pages(self, stop_id, start_datetime, end_datetime, data_dir, response_queue = None, on_response = None, 
+            counter = 1, response = None):
+        '''Pages through the departures of STOP_ID from START_DATETIME until END_DATETIME,
+        starting with the already retrieved first RESPONSE, if provided. Returns the next
+        free response file counter.'''
+        (itd_date, itd_time) = self._as_idt_date_time(start_datetime)
+        former_last_dep_datetime = None
+        while True:
+            if response is None:
+                response = self._get_route(self.efa_base_url, int(stop_id), itd_date, itd_time) 
+            # called before the response is written, so it may abort loading (see load_trips_from_queue)
+            if on_response:
+                on_response()
+            # paging continues after the last departure, even if it is dropped
+            last_dep_datetime = self._get_max_dep_datetime(response)
+            self._save_page(stop_id, counter, response, data_dir, response_queue)
+            
+            counter += 1
+            response = None
+            # if results past intended range were returned or no new departures returned for this stop, leave
+            if last_dep_datetime is not None and last_dep_datetime > end_datetime:
+                break
+            elif (last_dep_datetime is None or former_last_dep_datetime == last_dep_datetime):
+                # FIXME if efa only returns next 24h and this day is not served, we should
+                # increment by 24h
+                break
+            else:
+                # otherwise increment date/time and request again
+                (itd_date, itd_time) = self._as_idt_date_time(last_dep_datetime)
+                former_last_dep_datetime = last_dep_datetime
+        return counter
+
+    def _save_page(self, stop_id, counter, response, data_dir, response_queue = None):
+        '''Drops departures of ignored networks from RESPONSE, saves it as COUNTER'th
+        response of STOP_ID in DATA_DIR and puts it into RESPONSE_QUEUE.'''
+        if self.agencies_to_ignore:
+            self._filter_departures(response)
+        result_file_name = stop_id+"_"+str(counter)+".json"
+        if data_dir:
+            self._save(data_dir+"/"+result_file_name, response)
+            cacheindex.write_metadata(data_dir+"/"+result_file_name, response, stop_id)
+        if response_queue:
+            response_queue.put((result_file_name, response))
+
+    def _day_fingerprint(self, response, day_start, day_end):
+        '''Fingerprints the departures between DAY_START and DAY_END in RESPONSE by line key, 
+        time offset and destination. Returns the offset up to which RESPONSE covers the day 
+        and the fingerprint.'''
+        last_dep_datetime = self._get_max_dep_datetime(response)
+        covered_until = day_end if last_dep_datetime is None else min(last_dep_datetime, day_end)
+        return (covered_until - day_start, frozenset(
+            (trip.serving_line['key'], trip.scheduled_datetime - day_start, trip.direction) 
+            for trip in efa.DmResponse(response).trips 
+            if day_start <= trip.scheduled_datetime < day_end and not trip.is_ignored(self.agencies_to_ignore)))
+
+    def _is_same_day(self, fingerprint, other_fingerprint):
+        '''Two days are assumed to be the same, if they have the same departures 
+        within the period covered by both fingerprints.'''
+        covered = min(fingerprint[0], other_fingerprint[0])
+        return ({departure for departure in fingerprint[1] if departure[1] < covered} == 
+            {departure for departure in other_fingerprint[1] if departure[1] < covered})
+
+    def _load_day_pages(self, stop_id, day_end, response, pages, on_response = None):
+        '''Pages through the departures of STOP_ID from the already retrieved RESPONSE
+        until DAY_END, appending the pages not yet contained to PAGES. Returns the last page,
+        if it reaches into the next day, so it can serve as the next day's first page.'''
+        former_last_dep_datetime = None
+        while True:
+            if not pages or pages[-1] is not response:
+                pages.append(response)
+            last_dep_datetime = self._get_max_dep_datetime(response)
+            if last_dep_datetime is None or former_last_dep_datetime == last_dep_datetime:
+                return None
+            if last_dep_datetime >= day_end:
+                return response
+            (itd_date, itd_time) = self._as_idt_date_time(last_dep_datetime)
+            response = self._get_route(self.efa_base_url, int(stop_id), itd_date, itd_time)
+            if on_response:
+                on_response()
+            former_last_dep_datetime = last_dep_datetime
+
+    def _load_distinct_days_for_stop(self, stop_id, start_datetime, end_datetime, data_dir, response_queue = None, on_response = None):
+        '''Loads the departures of STOP_ID day by day (days start at START_DATETIME's time).
+        A day is fingerprinted by its first page, which is the last page of the day before,
+        if that reaches into this day. Days matching an earlier day are recorded as alias 
+        of this day and not loaded any further. Pages are kept until all days are checked,
+        so aliases are saved before any response and converters know them in advance.
+        If the first page already covers a whole day, skipping days would not save requests,
+        so all pages are loaded instead.'''
+        (itd_date, itd_time) = self._as_idt_date_time(start_datetime)
+        response = self._get_route(self.efa_base_url, int(stop_id), itd_date, itd_time)
+        last_dep_datetime = self._get_max_dep_datetime(response)
+        if last_dep_datetime is None or last_dep_datetime >= min(start_datetime + datetime.timedelta(days = 1), end_datetime):
+            self._load_pages(stop_id, start_datetime, end_datetime, data_dir, response_queue, on_response, 1, response)
+            return
+        if on_response:
+            on_response()
+        reference_days = []
+        aliases = {}
+        pages = []
+        day_start = start_datetime
+        while day_start < end_datetime:
+            day_end = min(day_start + datetime.timedelta(days = 1), end_datetime)
+            if response is None:
+                (itd_date, itd_time) = self._as_idt_date_time(day_start)
+                response = self._get_route(self.efa_base_url, int(stop_id), itd_date, itd_time)
+                if on_response:
+                    on_response()
+            fingerprint = self._day_fingerprint(response, day_start, day_end)
+            day = day_start.strftime('%Y%m%d')
+            reference_day = next((reference_day for (reference_fingerprint, reference_day) in reference_days 
+                if self._is_same_day(fingerprint, reference_fingerprint)), None)
+            if reference_day:
+                aliases[day] = reference_day
+                # a page reaching past this day still serves as the next day's first page
+                last_dep_datetime = self._get_max_dep_datetime(response)
+                if last_dep_datetime is None or last_dep_datetime < day_end:
+                    response = None
+            else:
+                reference_days.append((fingerprint, day))
+                response = self._load_day_pages(stop_id, day_end, response, pages, on_response)
+            day_start = day_end
+        if aliases:
+            self._save_service_date_aliases(stop_id, start_datetime, aliases, data_dir, response_queue)
+        for counter, page in enumerate(pages, 1):
+            self._save_page(stop_id, counter, page, data_dir, response_queue)
+
+    def _save_service_date_aliases(self, stop_id, start_datetime, aliases, data_dir, response_queue = None):
+        '''Appends the ALIASES (skipped day => day with same departures) of STOP_ID to
+        cacheindex.SERVICE_DATE_ALIASES_FILE in DATA_DIR and puts them into RESPONSE_QUEUE.'''
+        record = {'stop_id': stop_id, 'day_start': start_datetime.strftime('%H:%M'), 'aliases': aliases}
+        if data_dir:
+            cacheindex.append_record(os.path.join(data_dir, cacheindex.SERVICE_DATE_ALIASES_FILE), record)
+        if response_queue:
+            response_queue.put((cacheindex.SERVICE_DATE_ALIASES_FILE, record))
+        print('Skipped {} days repeating others for stop {}'.format(len(aliases), stop_id))
 
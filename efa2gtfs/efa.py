@@ -16,6 +16,8 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import datetime
+
 from . import util
 
 # See https://developers.google.com/transit/gtfs/reference/extended-route-types
@@ -42,6 +44,11 @@ route_type_and_colors = {
     19: ['707', '8f908f', 'FFFFFF'], # Bürgerbus => Special Needs (No good match available(?))
     }    
 
+def is_ignored(network, route_type, networks_to_ignore):
+    '''Departures of networks in NETWORKS_TO_IGNORE are ignored, unless they are
+    ON DEMAND (route_type 715), as these seem not to be published in GTFS 
+    currently, but we are interested in...'''
+    return network in networks_to_ignore and str(route_type) != '715'
 
 class DmResponse(object):
     def __init__(self, data):
@@ -134,27 +141,32 @@ class DmDeparture(object):
         return self.serving_line['stateless']
 
     @property
-    def service_id(self):
-        # first approximation for service_id: assume weekday, saturday, sunday service
-        weekday = self._data['dateTime']['weekday']
-        if weekday == '1':
-            service_id = '7' 
-        elif weekday == '6':
-            service_id = '6'
+    def service_date(self):
+        '''The service day this trip runs on, i.e. the date of the departure
+        at its first stop. Trips starting between 0am and 4am are assumed to
+        belong to the preceding service day (see util.convert_to_gtfs_time).'''
+        if self._data['prevStopSeq']:
+            prevStop = self._data['prevStopSeq'][0] if isinstance(self._data['prevStopSeq'], list) else self._data['prevStopSeq'] 
+            service_date = datetime.datetime.strptime(prevStop['ref']['depDateTime'].split(' ')[0], '%Y%m%d').date()
         else:
-            service_id = '1'
-        return service_id
+            dt = self._data['dateTime']
+            service_date = datetime.date(int(dt['year']), int(dt['month']), int(dt['day']))
+        if int(self.departure_datetime[:-3]) >= 24:
+            service_date -= datetime.timedelta(days=1)
+        return service_date
 
     @property
     def trip_id(self):
         '''Constructs a unique trip_id which is is built
         using the route_id, the schedule_id and its hour/minute
-        at the first stop.'''
+        at the first stop. The service days are not part of the
+        trip_id, they are collected per trip_id (see calendar.ServiceCalendar).
+        Trips sharing this id but running at different times are told apart
+        by the converter (see Converter.trip_variant_id).'''
         route_id = self.route_id
         key = self.serving_line['key']
-        service_id = self.service_id 
         hour_minute = self.departure_datetime
-        return '{}-{}-{}-{}'.format(route_id, service_id, key, hour_minute)    
+        return '{}-{}-{}'.format(route_id, key, hour_minute)    
     
     @property
     def departure_datetime(self):
@@ -164,9 +176,14 @@ class DmDeparture(object):
             depDateTime = prevStop['ref']['depDateTime']
             hour_minute = util.convert_to_gtfs_time(*(depDateTime.split(' ')[1].split(':')))
         else:
-            hour_minute = self.retrieve_hour_minute(trip['dateTime'])
+            hour_minute = self.retrieve_hour_minute(self._data['dateTime'])
         return hour_minute
  
+    @property
+    def scheduled_datetime(self):
+        '''Scheduled departure at the current stop.'''
+        return self._as_datetime(self._data['dateTime'])
+
     @property
     def direction(self):
         return self.serving_line['direction']
@@ -188,6 +205,9 @@ class DmDeparture(object):
     def network(self):
         return self.serving_line['liErgRiProj']['network']
 
+    def is_ignored(self, networks_to_ignore):
+        return is_ignored(self.network, self.route_type, networks_to_ignore)
+
     @property
     def route_type_and_colors(self):
         line = self.serving_line
@@ -203,7 +223,18 @@ class DmDeparture(object):
 
     @property
     def stop_time(self):
-        self.retrieve_hour_minute(self._data['dateTime'], self.start_hour) + ':00'
+        return self.retrieve_hour_minute(self._data['dateTime'], self.start_hour) + ':00'
+
+    @property
+    def delay(self):
+        '''Realtime delay in seconds at the current stop or None, if no realtime data is available.'''
+        if self._data.get('realDateTime'):
+            return int((self._as_datetime(self._data['realDateTime']) - self._as_datetime(self._data['dateTime'])).total_seconds())
+        return util.delay_in_seconds(self.serving_line.get('delay'))
+
+    def _as_datetime(self, dateTime):
+        return datetime.datetime(int(dateTime['year']), int(dateTime['month']), int(dateTime['day']), 
+            int(dateTime['hour']), int(dateTime['minute']))
 
     def retrieve_hour_minute(self, dateTime, start_hour_int = None):
         return util.convert_to_gtfs_time(dateTime['hour'],dateTime['minute'], start_hour_int)
@@ -266,3 +297,13 @@ class DmStop(object):
     def departure_date_time(self):
         stop_ref = self._data['ref']
         return stop_ref['depDateTime'] if 'depDateTime' in stop_ref else stop_ref['arrDateTime']
+
+    @property
+    def arrival_delay(self):
+        '''Realtime arrival delay in seconds or None, if no realtime data is available.'''
+        return util.delay_in_seconds(self._data['ref'].get('arrDelay'))
+
+    @property
+    def departure_delay(self):
+        '''Realtime departure delay in seconds or None, if no realtime data is available.'''
+        return util.delay_in_seconds(self._data['ref'].get('depDelay'))
@@ -0,0 +1,223 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv, hashlib, io, json, os, sys
+from zipfile import ZipFile
+from efa2gtfs import util
+
+# columns which contain the source file name and differ between builds
+IGNORED_COLUMNS = ['stop_source', 'stop_time_source']
+# keys of the gtfs files compared entity by entity
+ENTITY_KEYS = {
+    'agency.txt': 'agency_id',
+    'routes.txt': 'route_id',
+    'trips.txt': 'trip_id',
+    'stops.txt': 'stop_id',
+    'calendar.txt': 'service_id',
+    'transfers.txt': ('from_stop_id', 'to_stop_id'),
+}
+# keys of the gtfs files with several rows per key, compared by the sum of their row hashes
+GROUPED_KEYS = {
+    'calendar_dates.txt': 'service_id',
+    'frequencies.txt': 'trip_id',
+}
+# sums of row hashes are kept modulo 2^64
+HASH_MODULUS = 1 << 64
+
+def row_hash(values):
+    return int.from_bytes(hashlib.md5('\x1f'.join(values).encode('utf-8')).digest()[:8], 'big')
+
+class FeedDigest():
+    '''Streams a gtfs feed (zip file or folder) once and keeps a hash per entity
+    instead of the rows. stop_times are hashed per trip and per stop as sum of their
+    row hashes, so they need not be sorted. Columns containing the source file are ignored.
+    Per trip, its first departure and a hash of its stops are kept to recognize trips 
+    folded into frequencies.'''
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.entities = {}
+        self.trip_routes = {}
+        self.stop_coords = {}
+        self.trip_stop_times = {}
+        self.stop_stop_times = {}
+        self.trip_starts = {}
+        self.trip_stops = {}
+        self.frequency_windows = {}
+
+    def _rows(self, filename):
+        if os.path.isdir(self.feed):
+            path = os.path.join(self.feed, filename)
+            if not os.path.exists(path):
+                return
+            with open(path, 'r', encoding='utf-8', newline='') as csvfile:
+                yield from csv.DictReader(csvfile)
+        else:
+            with ZipFile(self.feed) as gtfszip:
+                if not filename in gtfszip.namelist():
+                    return
+                with gtfszip.open(filename) as csvfile:
+                    yield from csv.DictReader(io.TextIOWrapper(csvfile, encoding='utf-8', newline=''))
+
+    def _hash_entity(self, row):
+        return row_hash(value for (column, value) in sorted(row.items()) if not column in IGNORED_COLUMNS)
+
+    def _key(self, row, key):
+        return tuple(row[column] for column in key) if isinstance(key, tuple) else row[key]
+
+    def read(self):
+        for filename, key in ENTITY_KEYS.items():
+            entities = self.entities[filename] = {}
+            for row in self._rows(filename):
+                entities[self._key(row, key)] = self._hash_entity(row)
+                if filename == 'trips.txt':
+                    self.trip_routes[row['trip_id']] = row['route_id']
+                elif filename == 'stops.txt' and row['stop_lat'] and row['stop_lon']:
+                    self.stop_coords[row['stop_id']] = (float(row['stop_lat']), float(row['stop_lon']))
+
+        for filename, key in GROUPED_KEYS.items():
+            entities = self.entities[filename] = {}
+            for row in self._rows(filename):
+                entities[row[key]] = (entities.get(row[key], 0) + self._hash_entity(row)) % HASH_MODULUS
+                if filename == 'frequencies.txt':
+                    self.frequency_windows.setdefault(row['trip_id'], []).append((
+                        util.gtfs_time_to_seconds(row['start_time']), 
+                        util.gtfs_time_to_seconds(row['end_time']), 
+                        int(row['headway_secs'])))
+
+        for row in self._rows('stop_times.txt'):
+            trip_id = row['trip_id']
+            stop_id = row['stop_id']
+            trip_hash = self._hash_entity(row)
+            stop_hash = row_hash((trip_id, row['arrival_time'], row['departure_time']))
+            self.trip_stop_times[trip_id] = (self.trip_stop_times.get(trip_id, 0) + trip_hash) % HASH_MODULUS
+            self.stop_stop_times[stop_id] = (self.stop_stop_times.get(stop_id, 0) + stop_hash) % HASH_MODULUS
+            self.trip_stops[trip_id] = (self.trip_stops.get(trip_id, 0) + row_hash((row['stop_sequence'], stop_id))) % HASH_MODULUS
+            departure = util.gtfs_time_to_seconds(row['departure_time'])
+            if departure is not None and (not trip_id in self.trip_starts or departure < self.trip_starts[trip_id]):
+                self.trip_starts[trip_id] = departure
+        return self
+
+    def frequency_trips_by_route(self):
+        '''Returns the trip_ids of trips with frequencies, grouped by route_id.'''
+        trips_by_route = {}
+        for trip_id in self.frequency_windows:
+            trips_by_route.setdefault(self.trip_routes.get(trip_id, ''), []).append(trip_id)
+        return trips_by_route
+
+def _compare(old, new):
+    added = [key for key in new if not key in old]
+    removed = [key for key in old if not key in new]
+    changed = [key for key in new if key in old and old[key] != new[key]]
+    return added, removed, changed
+
+class FeedDiff():
+    '''Compares two feeds and reports added, removed and changed entities,
+    changes per route (trips added, removed, retimed, folded into or unfolded 
+    from frequencies) and per stop (moved, stop_times changed). Runs in time linear in feed size and keeps
+    only hashes per entity in memory.'''
+
+    # stops moved less than this distance (meters) are not reported as moved
+    min_move_distance = 1
+
+    def __init__(self, old_feed, new_feed):
+        self.old = FeedDigest(old_feed).read()
+        self.new = FeedDigest(new_feed).read()
+
+    def _is_folded(self, trip_id, digest, frequency_digest, frequency_trips_by_route):
+        '''Returns True, if trip TRIP_ID of DIGEST is covered by a trip of FREQUENCY_DIGEST
+        with frequencies, which belongs to the same route, serves the same stops and
+        runs at TRIP_ID's start time.'''
+        start = digest.trip_starts.get(trip_id)
+        if start is None:
+            return False
+        for frequency_trip_id in frequency_trips_by_route.get(digest.trip_routes.get(trip_id, ''), []):
+            if frequency_digest.trip_stops.get(frequency_trip_id) != digest.trip_stops.get(trip_id):
+                continue
+            for (start_time, end_time, headway) in frequency_digest.frequency_windows[frequency_trip_id]:
+                if start_time <= start < end_time and (start - start_time) % headway == 0:
+                    return True
+        return False
+
+    def _route_changes(self):
+        route_changes = {}
+        def count(trip_id, digest, change):
+            route_id = digest.trip_routes.get(trip_id, '')
+            changes = route_changes.setdefault(route_id, {'added_trips': 0, 'removed_trips': 0, 'retimed_trips': 0, 
+                'changed_trips': 0, 'folded_trips': 0, 'unfolded_trips': 0})
+            changes[change] += 1
+        (added, removed, changed) = _compare(self.old.entities['trips.txt'], self.new.entities['trips.txt'])
+        old_frequency_trips = self.old.frequency_trips_by_route()
+        new_frequency_trips = self.new.frequency_trips_by_route()
+        for trip_id in added:
+            if self._is_folded(trip_id, self.new, self.old, old_frequency_trips):
+                count(trip_id, self.new, 'unfolded_trips')
+            else:
+                count(trip_id, self.new, 'added_trips')
+        for trip_id in removed:
+            if self._is_folded(trip_id, self.old, self.new, new_frequency_trips):
+                count(trip_id, self.old, 'folded_trips')
+            else:
+                count(trip_id, self.old, 'removed_trips')
+        for trip_id in changed:
+            count(trip_id, self.new, 'changed_trips')
+        (added, removed, retimed) = _compare(self.old.trip_stop_times, self.new.trip_stop_times)
+        for trip_id in retimed:
+            count(trip_id, self.new, 'retimed_trips')
+        return route_changes
+
+    def _stop_changes(self):
+        stop_changes = {}
+        for stop_id, coords in self.new.stop_coords.items():
+            old_coords = self.old.stop_coords.get(stop_id)
+            if old_coords:
+                distance = util.distance(*old_coords, *coords)
+                if distance >= self.min_move_distance:
+                    stop_changes.setdefault(stop_id, {})['moved_meters'] = round(distance)
+        (added, removed, changed) = _compare(self.old.stop_stop_times, self.new.stop_stop_times)
+        for stop_id in changed:
+            stop_changes.setdefault(stop_id, {})['stop_times_changed'] = True
+        return stop_changes
+
+    def report(self):
+        files = {}
+        for filename in list(ENTITY_KEYS) + list(GROUPED_KEYS):
+            (added, removed, changed) = _compare(self.old.entities[filename], self.new.entities[filename])
+            files[filename] = {'added': sorted(added), 'removed': sorted(removed), 'changed': sorted(changed)}
+        return {
+            'files': files,
+            'routes': self._route_changes(),
+            'stops': self._stop_changes(),
+        }
+
+def main(args):
+    if len(args) < 2:
+        print('Usage: python -m efa2gtfs.feeddiff OLD_FEED NEW_FEED [REPORT_FILE]')
+        return 1
+    report = FeedDiff(args[0], args[1]).report()
+    for filename, changes in report['files'].items():
+        print('{}: {} added, {} removed, {} changed'.format(
+            filename, len(changes['added']), len(changes['removed']), len(changes['changed'])))
+    print('{} routes and {} stops with changes'.format(len(report['routes']), len(report['stops'])))
+    if len(args) > 2:
+        with open(args[2], 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent = 2, sort_keys = True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
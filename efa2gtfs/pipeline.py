@@ -0,0 +1,102 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import multiprocessing, queue
+import traceback
+from efa2gtfs.converter import Converter
+from efa2gtfs.crawler import EfaCrawler
+from efa2gtfs import cacheindex
+
+class ConverterProcessError(Exception):
+    pass
+
+class ConverterQueue():
+    '''Wraps the bounded RESPONSE_QUEUE of CONVERTER_PROCESS. While the queue is full,
+    put waits, but raises a ConverterProcessError as soon as the converter process
+    has died, instead of blocking forever.'''
+
+    # seconds to wait for a free slot before checking the converter process again
+    put_timeout = 1
+
+    def __init__(self, response_queue, converter_process):
+        self.response_queue = response_queue
+        self.converter_process = converter_process
+
+    def put(self, item):
+        while True:
+            try:
+                self.response_queue.put(item, timeout = self.put_timeout)
+                return
+            except queue.Full:
+                if not self.converter_process.is_alive():
+                    self.abandon()
+                    raise ConverterProcessError('Converter process died with exit code {}'.format(self.converter_process.exitcode))
+
+    def abandon(self):
+        '''Discards buffered items, as nobody reads them, so exiting doesn't block
+        on flushing them into the queue.'''
+        self.response_queue.cancel_join_thread()
+
+def convert_from_queue(response_queue, gtfs_filename, out_dir_name, agencies_to_ignore = None, frequencies = False):
+    '''Extracts gtfs info from every (file_name, response) tuple taken from RESPONSE_QUEUE
+    until None is received and exports the gtfs feed afterwards.'''
+    converter = Converter()
+    converter.prepare_import(agencies_to_ignore)
+    cnt = 0
+    while True:
+        item = response_queue.get()
+        if item is None:
+            break
+        (fname, response) = item
+        try:
+            if fname == cacheindex.SERVICE_DATE_ALIASES_FILE:
+                converter.add_service_date_aliases(response)
+                continue
+            cnt += 1
+            print('Convert ', fname, '(', cnt,'/?)')
+            converter.extract_gtfs_info_from_json(response, fname)
+        except Exception as err:
+            traceback.print_exc()
+    converter.export_gtfs(gtfs_filename, out_dir_name, frequencies)
+
+def crawl_and_convert(start_datetime, end_datetime, gtfs_filename, out_dir_name, 
+        data_dir = None, agencies_to_ignore = None, crawler = None, queue_size = 100, frequencies = False):
+    '''Crawls departures between START_DATETIME and END_DATETIME and converts every response
+    in a separate process as soon as it arrives. At most QUEUE_SIZE responses are buffered, 
+    if conversion lags behind, the crawler waits. Responses are only cached in DATA_DIR,
+    if provided. If the converter process dies, crawling is aborted with a ConverterProcessError.'''
+    if not crawler:
+        crawler = EfaCrawler(agencies_to_ignore = agencies_to_ignore)
+    response_queue = multiprocessing.Queue(queue_size)
+    converter_process = multiprocessing.Process(target = convert_from_queue, 
+        args = (response_queue, gtfs_filename, out_dir_name, agencies_to_ignore, frequencies))
+    converter_process.start()
+    converter_queue = ConverterQueue(response_queue, converter_process)
+    try:
+        crawler.load_trips_between(start_datetime, end_datetime, data_dir, response_queue = converter_queue)
+    finally:
+        try:
+            converter_queue.put(None)
+        except ConverterProcessError:
+            # already reported by the crawl or the converter process
+            pass
+        converter_process.join()
+    if converter_process.exitcode != 0:
+        converter_queue.abandon()
+        raise ConverterProcessError('Converter process died with exit code {}'.format(converter_process.exitcode))
+    return converter_process.exitcode
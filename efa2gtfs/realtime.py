@@ -0,0 +1,195 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime, json, os, time
+import threading, traceback
+from efa2gtfs import efa
+from efa2gtfs.converter import Converter
+
+try:
+    from google.transit import gtfs_realtime_pb2
+    from google.protobuf import json_format
+except ImportError:
+    # without gtfs-realtime-bindings, the feed is published as json rendering
+    gtfs_realtime_pb2 = None
+
+class TripDelays():
+    '''In-memory delay state per trip. Updates only touch trips whose delays changed,
+    and only these trips' feed entities are rebuilt for the next snapshot.'''
+
+    def __init__(self, max_age = 3 * 3600, clock = time.time):
+        '''Trips not updated for MAX_AGE seconds are dropped.'''
+        self.max_age = max_age
+        self._clock = clock
+        # trip_id => {stop_sequence: (stop_id, arrival_delay, departure_delay)}
+        self._delays = {}
+        self._start_dates = {}
+        self._updated = {}
+        self._entities = {}
+        self._dirty = set()
+
+    def update(self, trip_id, start_date, stop_sequence, stop_id, arrival_delay, departure_delay):
+        '''Records the delays of trip TRIP_ID at STOP_SEQUENCE. Returns True if they changed.'''
+        self._updated[trip_id] = self._clock()
+        stop_delays = self._delays.setdefault(trip_id, {})
+        delays = (stop_id, arrival_delay, departure_delay)
+        if stop_delays.get(stop_sequence) == delays:
+            return False
+        stop_delays[stop_sequence] = delays
+        self._start_dates[trip_id] = start_date
+        self._dirty.add(trip_id)
+        return True
+
+    def expire(self):
+        oldest = self._clock() - self.max_age
+        for trip_id in [trip_id for trip_id, updated in self._updated.items() if updated < oldest]:
+            for trip_state in (self._delays, self._start_dates, self._updated, self._entities):
+                trip_state.pop(trip_id, None)
+            self._dirty.discard(trip_id)
+
+    def _entity(self, trip_id):
+        stop_time_updates = []
+        for stop_sequence, (stop_id, arrival_delay, departure_delay) in sorted(self._delays[trip_id].items()):
+            stop_time_update = {'stopSequence': stop_sequence, 'stopId': stop_id}
+            if arrival_delay is not None:
+                stop_time_update['arrival'] = {'delay': arrival_delay}
+            if departure_delay is not None:
+                stop_time_update['departure'] = {'delay': departure_delay}
+            stop_time_updates.append(stop_time_update)
+        return {
+            'id': trip_id,
+            'tripUpdate': {
+                'trip': {'tripId': trip_id, 'startDate': self._start_dates[trip_id]},
+                'stopTimeUpdate': stop_time_updates,
+            }
+        }
+
+    def entities(self, as_protobuf = False):
+        '''Returns the feed entities of all trips, rebuilding only those of changed trips.'''
+        for trip_id in self._dirty:
+            entity = self._entity(trip_id)
+            if as_protobuf:
+                entity = json_format.ParseDict(entity, gtfs_realtime_pb2.FeedEntity())
+            self._entities[trip_id] = entity
+        self._dirty = set()
+        return self._entities.values()
+
+class RealtimePoller():
+    '''Polls departures with realtime information for a set of stops and periodically
+    publishes the delays as GTFS-RT TripUpdates (as protobuf, if gtfs-realtime-bindings
+    are installed, as json rendering otherwise). Trip ids follow the same scheme as
+    the static feed (see efa.DmDeparture.trip_id), stop_sequences and stop_ids are
+    derived by CONVERTER's rules (see Converter.trip_stops). If CONVERTER has imported
+    the static feed, trips running at other times than the efa trip_id's first variant
+    get the static variant's trip_id (see Converter.trip_variant_id), and stop_ids of 
+    its trips are taken from there, so they include stop_ids resolved from other responses.'''
+
+    def __init__(self, crawler, stop_ids, output_filename, publish_interval = 30, clock = time.time, converter = None):
+        self.crawler = crawler
+        self.converter = converter if converter is not None else Converter()
+        self.stop_ids = list(stop_ids)
+        self.output_filename = output_filename
+        self.publish_interval = publish_interval
+        self.as_protobuf = gtfs_realtime_pb2 is not None
+        self.trip_delays = TripDelays(clock = clock)
+        self._clock = clock
+        # guards trip_delays, which is updated by the polling loop and read by the publisher thread
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def process_response(self, dm_response):
+        '''Updates the delay state with all realtime information of DM_RESPONSE and
+        returns the number of changed stop delays.'''
+        changes = 0
+        gtfs_store = self.converter.gtfs_store
+        updates = []
+        for trip in self.converter.filtered_trips(efa.DmResponse(dm_response)):
+            trip_id = self.converter.trip_variant_id(trip.trip_id, self.converter.build_stop_times(trip), register = False)
+            start_date = trip.service_date.strftime('%Y%m%d')
+            static_stop_ids = {}
+            if gtfs_store.is_stop_times_extracted(trip_id):
+                static_stop_ids = {stop_time[gtfs_store.STOP_TIME_SEQ_NR]: stop_time[gtfs_store.STOP_TIME_STOP_ID_IDX] 
+                    for stop_time in gtfs_store.trip_stop_times(trip_id)}
+            for (stop_sequence, stop_id, stop) in self.converter.trip_stops(trip):
+                (arrival_delay, departure_delay) = (trip.delay, trip.delay) if stop is None else (stop.arrival_delay, stop.departure_delay)
+                if arrival_delay is not None or departure_delay is not None:
+                    updates.append((trip_id, start_date, stop_sequence, 
+                        static_stop_ids.get(stop_sequence, stop_id), arrival_delay, departure_delay))
+        with self._lock:
+            for update in updates:
+                changes += self.trip_delays.update(*update)
+        return changes
+
+    def poll_stop(self, stop_id):
+        (itd_date, itd_time) = self.crawler._as_idt_date_time(datetime.datetime.now())
+        response = self.crawler._get_route(self.crawler.efa_base_url, int(stop_id), itd_date, itd_time, use_realtime = True)
+        return self.process_response(response)
+
+    def snapshot(self):
+        '''Returns the current TripUpdates feed, serialized as protobuf or json.'''
+        self.trip_delays.expire()
+        header = {'gtfsRealtimeVersion': '2.0', 'incrementality': 'FULL_DATASET', 'timestamp': int(self._clock())}
+        entities = self.trip_delays.entities(self.as_protobuf)
+        if self.as_protobuf:
+            feed = json_format.ParseDict({'header': header}, gtfs_realtime_pb2.FeedMessage())
+            feed.entity.extend(entities)
+            return feed.SerializeToString()
+        return json.dumps({'header': header, 'entity': list(entities)}).encode('utf-8')
+
+    def publish(self):
+        '''Writes the current snapshot to output_filename. The file is replaced atomically,
+        so consumers never read a partially written feed.'''
+        with self._lock:
+            snapshot = self.snapshot()
+        tmp_filename = self.output_filename + '.tmp'
+        with open(tmp_filename, 'wb') as feed_file:
+            feed_file.write(snapshot)
+        os.replace(tmp_filename, self.output_filename)
+
+    def _publish_periodically(self):
+        '''Publishes a snapshot every publish_interval seconds until run() stops, 
+        independent of how long polling a stop takes.'''
+        next_publish = time.monotonic()
+        while True:
+            try:
+                self.publish()
+            except Exception as err:
+                traceback.print_exc()
+            next_publish += self.publish_interval
+            if self._stopped.wait(max(next_publish - time.monotonic(), 0)):
+                return
+
+    def run(self, rounds = None):
+        '''Polls all stops round by round (forever, if ROUNDS is None). Meanwhile, a
+        publisher thread publishes a snapshot every publish_interval seconds.'''
+        self._stopped.clear()
+        publisher = threading.Thread(target = self._publish_periodically, daemon = True)
+        publisher.start()
+        completed_rounds = 0
+        try:
+            while rounds is None or completed_rounds < rounds:
+                for stop_id in self.stop_ids:
+                    try:
+                        self.poll_stop(stop_id)
+                    except Exception as err:
+                        traceback.print_exc()
+                completed_rounds += 1
+        finally:
+            self._stopped.set()
+            publisher.join()
+        self.publish()
@@ -0,0 +1,140 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import glob, heapq
+from collections import Counter
+from efa2gtfs import cacheindex
+
+def lpt_makespan(costs, workers):
+    '''Returns the makespan of handing out jobs with the given COSTS, in the given order,
+    to WORKERS workers, each taking the next job as soon as it is idle.'''
+    loads = [0.0] * max(workers, 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+class CrawlCostEstimator():
+    '''Estimates the seconds needed to crawl a stop from the pages and bytes it needed 
+    in a previous crawl (see cacheindex.CRAWL_STATS_FILE) or, for stops without stats, 
+    from the number of cached responses. Seconds per page and per byte are fitted to the
+    recorded request latencies, so a stop slowed down by a temporarily slow server isn't
+    taken for a hub.'''
+
+    # assumed seconds per page, as long as no crawl stats are known
+    default_seconds_per_page = 1.0
+
+    def __init__(self):
+        self.stats = {}
+        self.cached_pages = Counter()
+        self.cached_departures = Counter()
+
+    def read_crawl_stats(self, dir_name):
+        for record in cacheindex.read_crawl_stats(dir_name):
+            # later crawls of the same stop replace earlier ones
+            self.stats[record['stop_id']] = record
+        return self
+
+    def read_cache(self, dir_name):
+        '''Counts responses and departures per stop in DIR_NAME using their metadata sidecars
+        (responses without sidecar are indexed).'''
+        for fname in glob.iglob(dir_name + '/*.json'):
+            metadata = cacheindex.read_metadata(fname)
+            self.cached_pages[metadata['stop_id']] += 1
+            self.cached_departures[metadata['stop_id']] += metadata['departures']
+        return self
+
+    @property
+    def seconds_per_page(self):
+        '''Average request latency per page.'''
+        pages = sum(record['pages'] for record in self.stats.values())
+        if not pages:
+            return self.default_seconds_per_page
+        return sum(record['seconds'] for record in self.stats.values()) / pages
+
+    def cost_model(self):
+        '''Returns (seconds_per_page, seconds_per_byte), fitted by least squares to the
+        crawl stats. Falls back to the average seconds per page, if the fit is degenerate.'''
+        records = list(self.stats.values())
+        pp = sum(record['pages'] ** 2 for record in records)
+        pb = sum(record['pages'] * record['bytes'] for record in records)
+        bb = sum(record['bytes'] ** 2 for record in records)
+        ps = sum(record['pages'] * record['seconds'] for record in records)
+        bs = sum(record['bytes'] * record['seconds'] for record in records)
+        determinant = pp * bb - pb * pb
+        if determinant > 1e-9 * pp * bb:
+            per_page = (ps * bb - bs * pb) / determinant
+            per_byte = (bs * pp - ps * pb) / determinant
+            if per_page >= 0 and per_byte >= 0:
+                return (per_page, per_byte)
+        return (self.seconds_per_page, 0.0)
+
+    def estimate(self, stop_ids):
+        '''Returns a dict with the estimated crawl seconds per stop of STOP_IDS. Stops
+        neither crawled nor cached before are assumed to need a single page.'''
+        seconds_per_page = self.seconds_per_page
+        (per_page, per_byte) = self.cost_model()
+        costs = {}
+        for stop_id in stop_ids:
+            if stop_id in self.stats:
+                record = self.stats[stop_id]
+                costs[stop_id] = record['pages'] * per_page + record['bytes'] * per_byte
+            else:
+                costs[stop_id] = max(self.cached_pages[stop_id], 1) * seconds_per_page
+        return costs
+
+class CrawlScheduler():
+    '''Orders stops by descending estimated crawl cost (longest processing time first),
+    so that expensive stops like main stations don't keep a single worker busy at the
+    end of a parallel crawl.'''
+
+    def __init__(self, stop_ids, estimator):
+        self.costs = estimator.estimate(list(stop_ids))
+        # departures break ties between stops with the same estimate
+        self._order = sorted(self.costs, key = lambda stop_id: (self.costs[stop_id], estimator.cached_departures[stop_id]), reverse = True)
+
+    def ordered_stops(self):
+        return list(self._order)
+
+    def total_work(self):
+        return sum(self.costs.values())
+
+    def predicted_makespan(self, workers):
+        return lpt_makespan((self.costs[stop_id] for stop_id in self._order), workers)
+
+    def enqueue(self, work_queue, start_datetime, end_datetime, instance = 'default'):
+        '''Enqueues all stops into the workqueue.CrawlWorkQueue WORK_QUEUE, with their
+        estimated cost as priority.'''
+        return work_queue.enqueue(self._order, start_datetime, end_datetime, instance, self.costs)
+
+    def report(self, workers, work_queue = None, instance = 'default'):
+        '''Prints and returns the predicted makespan for WORKERS workers, the lower bound
+        total work / workers and, if a WORK_QUEUE is provided, the actual makespan.'''
+        report = {
+            'workers': workers,
+            'total_work': self.total_work(),
+            'lower_bound': self.total_work() / max(workers, 1),
+            'predicted_makespan': self.predicted_makespan(workers),
+        }
+        print('Predicted makespan {:.0f}s for {} workers (total work {:.0f}s, lower bound {:.0f}s)'.format(
+            report['predicted_makespan'], workers, report['total_work'], report['lower_bound']))
+        if work_queue:
+            (makespan, total_work, actual_workers) = work_queue.timings(instance)
+            report['actual_makespan'] = makespan
+            report['actual_total_work'] = total_work
+            print('Actual makespan {:.0f}s with {} workers (total work {:.0f}s)'.format(makespan, actual_workers, total_work))
+        return report
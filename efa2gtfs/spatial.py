@@ -0,0 +1,248 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+from collections import Counter
+from efa2gtfs import util
+
+METERS_PER_DEGREE = 2 * math.pi * util.EARTH_RADIUS / 360
+
+def gid_of(stop_id):
+    '''Returns the gid (e.g. de:08127:20545) of a pointGid (e.g. de:08127:20545:0:2)
+    or gid stop_id, or None, if stop_id is neither.'''
+    parts = str(stop_id).split(':')
+    if len(parts) >= 4:
+        return stop_id.rsplit(':', 2)[0]
+    elif len(parts) == 3:
+        return stop_id
+    return None
+
+class GridIndex():
+    '''Uniform grid over WGS84 coordinates with cells of about CELL_SIZE meters,
+    which allows to retrieve all points within a radius by scanning the surrounding
+    cells only.'''
+
+    def __init__(self, cell_size = 250):
+        self.cell_size = cell_size
+        self._lat_step = cell_size / METERS_PER_DEGREE
+        self._cells = {}
+
+    def _lon_step(self, row):
+        # cells have the same width in meters, so the longitude step grows with latitude
+        return self._lat_step / max(math.cos(math.radians(row * self._lat_step)), 0.01)
+
+    def _cell(self, lat, lon):
+        row = math.floor(lat / self._lat_step)
+        return (row, math.floor(lon / self._lon_step(row)))
+
+    def add(self, key, lat, lon):
+        self._cells.setdefault(self._cell(lat, lon), []).append((key, lat, lon))
+
+    def within(self, lat, lon, radius):
+        '''Yields (key, distance) for all points within RADIUS meters of lat/lon.'''
+        row_count = math.ceil(radius / self.cell_size)
+        center_row = math.floor(lat / self._lat_step)
+        for row in range(center_row - row_count, center_row + row_count + 1):
+            lon_step = self._lon_step(row)
+            center_col = math.floor(lon / lon_step)
+            col_count = math.ceil(radius / self.cell_size) + 1
+            for col in range(center_col - col_count, center_col + col_count + 1):
+                for (key, point_lat, point_lon) in self._cells.get((row, col), ()):
+                    dist = util.distance(lat, lon, point_lat, point_lon)
+                    if dist <= radius:
+                        yield key, dist
+
+class StopLocator():
+    '''Validates stop coordinates against the stops sharing their gid and against
+    their neighbours in journey patterns and clusters platforms into parent stations.'''
+
+    # stops further away from the median of their gid siblings are reported
+    max_sibling_distance = 1000
+    # a stop is reported as detour, if visiting it is this factor longer than
+    # going directly from the previous to the next stop...
+    max_detour_factor = 3
+    # ... and the detour is at least this long (meters)
+    min_detour = 3000
+    # platforms of a station must be within this radius of their median position
+    station_radius = 300
+
+    def __init__(self, gtfs_store):
+        self.gtfs_store = gtfs_store
+        self.suspicious_stops = {}
+        self.fixed_stops = {}
+
+    def _coords(self, stop_id):
+        stop = self.gtfs_store.stops.get(stop_id)
+        if stop is None or stop[self.gtfs_store.STOP_LAT_IDX] == '' or stop[self.gtfs_store.STOP_LON_IDX] == '':
+            return None
+        return (float(stop[self.gtfs_store.STOP_LAT_IDX]), float(stop[self.gtfs_store.STOP_LON_IDX]))
+
+    def _set_coords(self, stop_id, lat, lon):
+        stop = self.gtfs_store.stops[stop_id]
+        stop[self.gtfs_store.STOP_LAT_IDX] = lat
+        stop[self.gtfs_store.STOP_LON_IDX] = lon
+
+    def _stops_by_gid(self):
+        stops_by_gid = {}
+        for stop_id in self.gtfs_store.stops:
+            gid = gid_of(stop_id)
+            coords = self._coords(stop_id)
+            if gid and coords:
+                stops_by_gid.setdefault(gid, []).append((stop_id, coords))
+        return stops_by_gid
+
+    def _median(self, coords):
+        lats = sorted(lat for (lat, lon) in coords)
+        lons = sorted(lon for (lat, lon) in coords)
+        return (lats[len(lats) // 2], lons[len(lons) // 2])
+
+    def _report(self, stop_id, reason):
+        self.suspicious_stops[stop_id] = reason
+        print('WARN: stop {} {}'.format(stop_id, reason))
+
+    def _swap_coords(self, stop_id, lat, lon):
+        self._set_coords(stop_id, lat, lon)
+        self.fixed_stops[stop_id] = [lat, lon]
+        print('WARN: swapped lat/lon for stop {}, you might add {} to Converter.fixed_coords'.format(stop_id, {stop_id: [lat, lon]}))
+
+    def check_coordinates(self):
+        '''Reports stops far from the median position of their gid siblings or forming
+        a detour between their neighbours in a journey pattern. If swapping lat/lon
+        resolves the issue, coordinates are swapped. Returns the suspicious stops
+        which could not be fixed.'''
+        for gid, stops in self._stops_by_gid().items():
+            if len(stops) < 3:
+                # with less than three stops, we can't tell which one is wrong
+                continue
+            (median_lat, median_lon) = self._median([coords for (stop_id, coords) in stops])
+            for stop_id, (lat, lon) in stops:
+                if util.distance(lat, lon, median_lat, median_lon) <= self.max_sibling_distance:
+                    continue
+                if util.distance(lon, lat, median_lat, median_lon) <= self.max_sibling_distance:
+                    self._swap_coords(stop_id, lon, lat)
+                else:
+                    self._report(stop_id, 'is more than {}m away from stops with gid {}'.format(self.max_sibling_distance, gid))
+
+        for pattern in self.gtfs_store.patterns:
+            if pattern:
+                self._check_detours([stop_time[self.gtfs_store.PATTERN_STOP_ID_IDX] for stop_time in pattern])
+        return self.suspicious_stops
+
+    def _check_detours(self, stop_ids):
+        for (prev_id, stop_id, next_id) in zip(stop_ids, stop_ids[1:], stop_ids[2:]):
+            if stop_id in self.suspicious_stops or stop_id in self.fixed_stops:
+                continue
+            prev_coords = self._coords(prev_id)
+            coords = self._coords(stop_id)
+            next_coords = self._coords(next_id)
+            if not (prev_coords and coords and next_coords):
+                continue
+            direct = util.distance(*prev_coords, *next_coords)
+            detour = util.distance(*prev_coords, *coords) + util.distance(*coords, *next_coords)
+            if detour - direct < self.min_detour or detour < self.max_detour_factor * direct:
+                continue
+            swapped = (coords[1], coords[0])
+            swapped_detour = util.distance(*prev_coords, *swapped) + util.distance(*swapped, *next_coords)
+            if swapped_detour - direct < self.min_detour:
+                self._swap_coords(stop_id, *swapped)
+            else:
+                self._report(stop_id, 'is a {:.0f}m detour between {} and {}'.format(detour - direct, prev_id, next_id))
+
+    def cluster_stations(self):
+        '''Creates a parent station per gid for platforms sharing this gid and lying within
+        station_radius of their median position. Stops without gid, but the same name as the
+        station, which are within station_radius, are added as well.'''
+        index = GridIndex(self.station_radius)
+        for stop_id in self.gtfs_store.stops:
+            coords = self._coords(stop_id)
+            if coords and not gid_of(stop_id):
+                index.add(stop_id, *coords)
+
+        station_count = 0
+        for gid, stops in self._stops_by_gid().items():
+            if self.gtfs_store.stop_refs[gid] > 0:
+                # gid is served as stop itself and can't become a station
+                continue
+            platforms = [(stop_id, coords) for (stop_id, coords) in stops if stop_id != gid and not stop_id in self.suspicious_stops]
+            if len(platforms) < 2:
+                continue
+            (lat, lon) = self._median([coords for (stop_id, coords) in platforms])
+            members = [stop_id for (stop_id, coords) in platforms if util.distance(*coords, lat, lon) <= self.station_radius]
+            if len(members) < 2:
+                continue
+            name = Counter(self.gtfs_store.stops[stop_id][self.gtfs_store.STOP_NAME_IDX] for stop_id in members).most_common(1)[0][0]
+            for (stop_id, distance) in index.within(lat, lon, self.station_radius):
+                if self.gtfs_store.stops[stop_id][self.gtfs_store.STOP_NAME_IDX] == name:
+                    members.append(stop_id)
+            self.gtfs_store.add_station(gid, name, lat, lon, members)
+            station_count += 1
+        print('Clustered platforms into {} stations'.format(station_count))
+
+class TransferBuilder():
+    '''Derives walking transfers between stops within max_distance of each other and 
+    between platforms sharing a gid. Neighbours are looked up in a GridIndex, so the 
+    work grows with the number of stops times their neighbours.'''
+
+    # stops within this distance (meters) are connected by a transfer
+    max_distance = 300
+    # platforms sharing a gid are connected up to this distance (meters)
+    max_gid_distance = 1000
+    # meters per second
+    walking_speed = 1.0
+    # seconds at least needed for any transfer
+    min_transfer_time = 60
+
+    def __init__(self, gtfs_store):
+        self.gtfs_store = gtfs_store
+
+    def _transfer_time(self, distance):
+        return max(self.min_transfer_time, int(math.ceil(distance / self.walking_speed)))
+
+    def build(self):
+        '''Returns transfers as (from_stop_id, to_stop_id, transfer_type, min_transfer_time) rows,
+        with transfer_type 2 (min_transfer_time required). Stations are not connected.'''
+        store = self.gtfs_store
+        index = GridIndex(self.max_distance)
+        coords = {}
+        stops_by_gid = {}
+        for stop_id, stop in store.stops.items():
+            if stop[store.STOP_LAT_IDX] == '' or stop[store.STOP_LON_IDX] == '' or store._is_station(stop):
+                continue
+            coords[stop_id] = (float(stop[store.STOP_LAT_IDX]), float(stop[store.STOP_LON_IDX]))
+            index.add(stop_id, *coords[stop_id])
+            gid = gid_of(stop_id)
+            if gid:
+                stops_by_gid.setdefault(gid, []).append(stop_id)
+
+        distances = {}
+        for stop_id, (lat, lon) in coords.items():
+            for (other_id, distance) in index.within(lat, lon, self.max_distance):
+                if other_id != stop_id:
+                    distances[(stop_id, other_id)] = distance
+        for gid, stop_ids in stops_by_gid.items():
+            for stop_id in stop_ids:
+                for other_id in stop_ids:
+                    if other_id != stop_id and not (stop_id, other_id) in distances:
+                        distance = util.distance(*coords[stop_id], *coords[other_id])
+                        if distance <= self.max_gid_distance:
+                            distances[(stop_id, other_id)] = distance
+
+        transfers = [[from_id, to_id, 2, self._transfer_time(distance)] 
+            for (from_id, to_id), distance in sorted(distances.items())]
+        print('Derived {} transfers between {} stops'.format(len(transfers), len(coords)))
+        return transfers
@@ -16,20 +16,33 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import csv
+import csv, os, sqlite3
+from collections import Counter
 from zipfile import ZipFile, ZIP_DEFLATED
+from efa2gtfs.calendar import ServiceCalendar
+from efa2gtfs import util
+from efa2gtfs.validator import FeedChecker
+from efa2gtfs.spatial import TransferBuilder
 
 class GtfsStore():
     STOP_TIME_TRIP_ID_IDX = 0
     STOP_TIME_SEQ_NR = 1
     STOP_TIME_STOP_ID_IDX = 4
-    
-    agencies = {}
-    stops = {}
-    routes = {}
-    trips = {}
-    stop_times = {}
-    calendar_dates = []
+    STOP_TIME_SOURCE_IDX = 8
+    TRIP_ROUTE_ID_IDX = 1
+    TRIP_SERVICE_ID_IDX = 2
+    TRIP_HEADSIGN_IDX = 3
+    ROUTE_AGENCY_ID_IDX = 1
+    ROUTE_TYPE_IDX = 5
+    STOP_NAME_IDX = 1
+    STOP_LAT_IDX = 3
+    STOP_LON_IDX = 4
+    STOP_LOCATION_TYPE_IDX = 6
+    STOP_PARENT_STATION_IDX = 7
+    # stop_times are stored as journey patterns, i.e. tuples of 
+    # (stop_sequence,stop_id,arrival_offset,departure_offset,stop_headsign,pickup_type,drop_off_type)
+    # with offsets in seconds relative to the trip's start time
+    PATTERN_STOP_ID_IDX = 1
     
     agencies_fields = 'agency_id,agency_name,agency_url,agency_timezone'
     feed_info_fields = 'feed_id,feed_publisher_name,feed_publisher_url,feed_lang'
@@ -37,102 +50,382 @@ class GtfsStore():
     calendar_dates_fields = 'date,service_id,exception_type'
     route_fields = 'route_id,agency_id,route_short_name,route_long_name,route_desc,route_type,route_color,route_text_color'
     trip_fields = 'trip_id,route_id,service_id,trip_headsign' 
-    stop_fields = 'stop_id,stop_name,platform_code,stop_lat,stop_lon,stop_source'
+    stop_fields = 'stop_id,stop_name,platform_code,stop_lat,stop_lon,stop_source,location_type,parent_station'
     stop_time_fields = 'trip_id,stop_sequence,arrival_time,departure_time,stop_id,stop_headsign,pickup_type,drop_off_type,stop_time_source'
+    frequencies_fields = 'trip_id,start_time,end_time,headway_secs,exact_times'
+    transfers_fields = 'from_stop_id,to_stop_id,transfer_type,min_transfer_time'
+    # (table, column) to index in sqlite export
+    sqlite_indexes = [('stop_times', 'trip_id'), ('stop_times', 'stop_id'), 
+        ('trips', 'trip_id'), ('trips', 'route_id'), ('trips', 'service_id'),
+        ('routes', 'route_id'), ('stops', 'stop_id'), 
+        ('calendar', 'service_id'), ('calendar_dates', 'service_id'), ('frequencies', 'trip_id'),
+        ('transfers', 'from_stop_id')]
     
    
-    def init_static_content(self):
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        '''Discards all cached entities, so the store can be reused for another feed.'''
+        self.agencies = {}
+        self.stops = {}
+        self.routes = {}
+        self.trips = {}
+        # journey pattern tuple => pattern_id
+        self.journey_patterns = {}
+        # pattern_id => journey pattern tuple
+        self.patterns = []
+        # trip_id => (pattern_id, start time in seconds, source)
+        self.trip_patterns = {}
+        # reference counts, maintained while caching: number of trips per pattern,
+        # of used patterns per stop, of trips per route and of routes per agency
+        self.pattern_refs = []
+        # pattern_id => stop_ids of the pattern which are not pointGids, computed on demand
+        self.pattern_unresolved_stop_ids = {}
+        self.stop_refs = Counter()
+        self.route_refs = Counter()
+        self.agency_refs = Counter()
+        self.frequencies = []
+        self.transfers = []
+        self.calendar = {}
+        self.calendar_dates = []
+        self.service_calendar = ServiceCalendar()
+        self.init_static_content()
+    
+    def init_static_content(self, service_period = None):
+        '''Initializes feed_info and sets the service period of the calendar. SERVICE_PERIOD 
+        is an optional (start_date, end_date) tuple of the crawled period. If not provided, 
+        it is derived from the observed service dates. Recorded service dates are kept, 
+        so several imports add to the same calendar.'''
         self.feed_info= {'nvbv': ['nvbv','mfdz','http://mfdz.de/','de']}
-        self.calendar = {'1': ['1', '20180601','20181209', 1, 1, 1, 1, 1, 0, 0],
-                         '6': ['6', '20180601','20181209', 0, 0, 0, 0, 0, 1, 0],
-                         '7': ['7', '20180601','20181209', 0, 0, 0, 0, 0, 0, 1]}
-        self.calendar_dates = [
-            ['20181003', '7', '1'],['20181003', '1', '2'], # Tag der deutschen Einheit
-            ['20181101', '7', '1'],['20181101', '1', '2'], # Allerheiligen
-            ['20181225', '7', '1'],['20181225', '1', '2'], # 1. Weihnachtsfeiertag
-            ['20181226', '7', '1'],['20181226', '1', '2'],] # 2. Weihnachtsfeiertag
+        self.service_calendar.service_period = service_period
+    
+    def add_service_date(self, trip_id, service_date):
+        self.service_calendar.add(trip_id, service_date)
+    
+    def derive_calendar(self):
+        '''Derives calendar and calendar_dates from the recorded service dates
+        and assigns the resulting service_ids to the trips. Stop_times of trips
+        not running within the service period are dropped, so that prune_orphans
+        removes these trips.'''
+        trip_ids = self.trips.keys() & self.trip_patterns.keys()
+        service_ids, self.calendar, self.calendar_dates = self.service_calendar.derive(trip_ids)
+        for trip_id in trip_ids:
+            if not trip_id in service_ids:
+                print('WARN: trip {} dropped, as it does not run within the service period'.format(trip_id))
+                self._reference_pattern(self.trip_patterns.pop(trip_id)[0], -1)
+        for trip_id, trip in self.trips.items():
+            trip[self.TRIP_SERVICE_ID_IDX] = service_ids.get(trip_id, '')
         
-    def cache(self, entitities, entity_store, key_columns = 1):
-        '''Caches entities in entity_store, using the concatenated key column values as key'''
+    def cache(self, entitities, entity_store):
+        '''Caches entities in entity_store, using the first column value as key'''
         for entity in entitities:
-            if key_columns == 2:
-                # TODO Currently, only stop_times uses 2 key_columns
-                # so we perform stop_times dependend workaround for stop_id here
-                key = entity[0]+"#"+str(entity[1])
-                # current_stop has no pointGid, so we'll override the stop info as soon as we found it
-                if not key in entity_store or (self.is_stop_id_a_point_gid(entity) and self.is_stop_id_a_point_gid(entity_store[key])):
-                    entity_store[key] = entity
-            else:
-                key = entity[0]
-                if not key in entity_store:
-                    entity_store[key] = entity
+            key = entity[0]
+            if not key in entity_store:
+                entity_store[key] = entity
+                self._add_references(entity_store, entity)
+    
+    def _add_references(self, entity_store, entity):
+        if entity_store is self.trips:
+            self.route_refs[entity[self.TRIP_ROUTE_ID_IDX]] += 1
+        elif entity_store is self.routes:
+            self.agency_refs[entity[self.ROUTE_AGENCY_ID_IDX]] += 1
+    
+    def cache_stop_times(self, trips_stop_times):
+        '''Caches the stop_times of every trip in TRIPS_STOP_TIMES (a list of stop_time rows
+        per trip). Only the first stop_times reported for a trip are kept.'''
+        for stop_times in trips_stop_times:
+            if not stop_times:
+                continue
+            trip_id = stop_times[0][self.STOP_TIME_TRIP_ID_IDX]
+            if not trip_id in self.trip_patterns:
+                self._set_trip_stop_times(trip_id, stop_times)
+    
+    def _set_trip_stop_times(self, trip_id, stop_times):
+        '''Stores STOP_TIMES as reference to an interned journey pattern and the trip's start time,
+        so that trips serving the same stops with the same running times share their pattern.'''
+        start_time = None
+        for stop_time in stop_times:
+            start_time = util.gtfs_time_to_seconds(stop_time[3]) 
+            if start_time is not None:
+                break
+        pattern = tuple(
+            (stop_time[1],
+             stop_time[self.STOP_TIME_STOP_ID_IDX],
+             self._offset(stop_time[2], start_time),
+             self._offset(stop_time[3], start_time),
+             *stop_time[5:8]) for stop_time in stop_times)
+        pattern_id = self.journey_patterns.get(pattern)
+        if pattern_id is None:
+            pattern_id = len(self.patterns)
+            self.journey_patterns[pattern] = pattern_id
+            self.patterns.append(pattern)
+            self.pattern_refs.append(0)
+        previous = self.trip_patterns.get(trip_id)
+        self.trip_patterns[trip_id] = (pattern_id, start_time, stop_times[0][self.STOP_TIME_SOURCE_IDX])
+        self._reference_pattern(pattern_id, 1)
+        if previous:
+            self._reference_pattern(previous[0], -1)
+    
+    def _reference_pattern(self, pattern_id, delta):
+        '''Updates the number of trips using pattern PATTERN_ID and, if the pattern 
+        becomes used or unused, the reference counts of its stops. Unused patterns
+        are discarded.'''
+        count = self.pattern_refs[pattern_id]
+        self.pattern_refs[pattern_id] = count + delta
+        pattern = self.patterns[pattern_id]
+        if count == 0 or count + delta == 0:
+            for stop_time in pattern:
+                self.stop_refs[stop_time[self.PATTERN_STOP_ID_IDX]] += delta
+        if count + delta == 0:
+            del self.journey_patterns[pattern]
+            self.patterns[pattern_id] = None
+            self.pattern_unresolved_stop_ids.pop(pattern_id, None)
+    
+    def _offset(self, gtfs_time, start_time):
+        seconds = util.gtfs_time_to_seconds(gtfs_time)
+        return None if seconds is None else seconds - start_time
+    
+    def trip_stop_times(self, trip_id):
+        '''Expands the journey pattern of trip TRIP_ID into stop_time rows.'''
+        (pattern_id, start_time, source) = self.trip_patterns[trip_id]
+        return [[
+            trip_id,
+            stop_sequence,
+            util.seconds_to_gtfs_time(None if arrival_offset is None else start_time + arrival_offset),
+            util.seconds_to_gtfs_time(None if departure_offset is None else start_time + departure_offset),
+            stop_id,
+            stop_headsign,
+            pickup_type,
+            drop_off_type,
+            source] for (stop_sequence, stop_id, arrival_offset, departure_offset, stop_headsign, pickup_type, drop_off_type) 
+                in self.patterns[pattern_id]]
     
     def is_stop_times_extracted(self, trip_id):
-        return trip_id+"#1" in self.stop_times
-        
-    def is_stop_id_a_point_gid(self, stop_time):
-        return ':' in stop_time[self.STOP_TIME_STOP_ID_IDX]
+        return trip_id in self.trip_patterns
         
-    def stops_without_point_gid(self, trip_id):
-        stop_times_without_point_gid = []
-        stop_seq = 1
-        while True:
-            stop_time_id = str(trip_id)+"#"+str(stop_seq)
-            if stop_time_id not in self.stop_times:
-                return stop_times_without_point_gid
-            stop_time = self.stop_times[stop_time_id]
-            if not self.is_stop_id_a_point_gid(stop_time):
-                stop_times_without_point_gid.append(stop_time)
-            stop_seq += 1
+    def is_stop_id_a_point_gid(self, stop_id):
+        return ':' in stop_id
             
-    def update_stop_id(self, stop, stop_id):
-        key= str(stop[0])+"#"+str(stop[1])
-        self.stop_times[key][self.STOP_TIME_STOP_ID_IDX] = stop_id
-                
+    def unresolved_stop_ids(self, trip_id):
+        '''Returns the set of stop_ids of trip TRIP_ID which are not pointGids.
+        The set is shared by all trips of the same journey pattern.'''
+        pattern_id = self.trip_patterns[trip_id][0]
+        stop_ids = self.pattern_unresolved_stop_ids.get(pattern_id)
+        if stop_ids is None:
+            stop_ids = frozenset(stop_time[self.PATTERN_STOP_ID_IDX] for stop_time in self.patterns[pattern_id]
+                if not self.is_stop_id_a_point_gid(stop_time[self.PATTERN_STOP_ID_IDX]))
+            self.pattern_unresolved_stop_ids[pattern_id] = stop_ids
+        return stop_ids
+    
+    def update_stop_ids(self, trip_id, stop_ids):
+        '''Replaces the stop_ids of trip TRIP_ID according to the mapping STOP_IDS
+        (old stop_id => new stop_id). The trip is reassigned to a pattern only once.'''
+        stop_times = self.trip_stop_times(trip_id)
+        for stop_time in stop_times:
+            stop_id = stop_time[self.STOP_TIME_STOP_ID_IDX]
+            if stop_id in stop_ids:
+                stop_time[self.STOP_TIME_STOP_ID_IDX] = stop_ids[stop_id]
+        self._set_trip_stop_times(trip_id, stop_times)
+    
+    def add_station(self, station_id, name, lat, lon, stop_ids):
+        '''Adds a station (location_type 1) and sets it as parent_station of
+        all stops in STOP_IDS, which have no parent_station yet.'''
+        self.stops[station_id] = [station_id, name, '', lat, lon, '', 1, '']
+        for stop_id in stop_ids:
+            stop = self.stops[stop_id]
+            stop.extend([''] * (self.STOP_PARENT_STATION_IDX + 1 - len(stop)))
+            if not stop[self.STOP_PARENT_STATION_IDX]:
+                stop[self.STOP_LOCATION_TYPE_IDX] = 0
+                stop[self.STOP_PARENT_STATION_IDX] = station_id
+    
+    def _is_station(self, stop):
+        return len(stop) > self.STOP_LOCATION_TYPE_IDX and stop[self.STOP_LOCATION_TYPE_IDX] == 1
+    
+    def _parent_station(self, stop):
+        return stop[self.STOP_PARENT_STATION_IDX] if len(stop) > self.STOP_PARENT_STATION_IDX else ''
+    
+    def derive_frequencies(self, min_trips = 3):
+        '''Replaces every run of at least MIN_TRIPS trips of the same route, service, headsign 
+        and journey pattern, which start at a constant headway, by its first trip and a 
+        frequencies entry (exact_times=1). Returns the trip_ids of the replaced trips.'''
+        trips_by_pattern = {}
+        for trip_id, (pattern_id, start_time, source) in self.trip_patterns.items():
+            trip = self.trips.get(trip_id)
+            if trip is None or start_time is None:
+                continue
+            key = (trip[self.TRIP_ROUTE_ID_IDX], trip[self.TRIP_SERVICE_ID_IDX], trip[self.TRIP_HEADSIGN_IDX], pattern_id)
+            trips_by_pattern.setdefault(key, []).append((start_time, trip_id))
+        
+        self.frequencies = []
+        replaced_trips = set()
+        for trips in trips_by_pattern.values():
+            trips.sort()
+            idx = 0
+            while idx < len(trips) - 1:
+                headway = trips[idx + 1][0] - trips[idx][0]
+                end = idx + 1
+                while end + 1 < len(trips) and trips[end + 1][0] - trips[end][0] == headway:
+                    end += 1
+                if headway > 0 and end - idx + 1 >= min_trips:
+                    self.frequencies.append([
+                        trips[idx][1],
+                        util.seconds_to_gtfs_time(trips[idx][0]),
+                        util.seconds_to_gtfs_time(trips[end][0] + headway),
+                        headway,
+                        1])
+                    replaced_trips.update(trip_id for start_time, trip_id in trips[idx + 1:end + 1])
+                    idx = end + 1
+                else:
+                    idx = end
+        return replaced_trips
+    
+    def _stop_time_rows(self, excluded_trips):
+        for trip_id in sorted(self.trip_patterns):
+            if not trip_id in excluded_trips:
+                yield from self.trip_stop_times(trip_id)
         
-    def export(self, gtfszip_filename, gtfsfolder):
+    def export(self, gtfszip_filename, gtfsfolder, frequencies = False, strict = False, sqlite_filename = None, transfers = False):
+        '''Writes all gtfs files to GTFSFOLDER and zips them into GTFSZIP_FILENAME.
+        Trips not running within the service period and orphaned entities are
+        pruned before. If FREQUENCIES is True, trips running 
+        at regular headways are exported via frequencies.txt. If TRANSFERS is True,
+        walking transfers between nearby stops are exported via transfers.txt.
+        While writing, the feed is checked and validation_report.json is written to 
+        GTFSFOLDER. If STRICT, export fails with a FeedValidationError on errors.
+        If SQLITE_FILENAME is provided, the feed is additionally written to this
+        sqlite database.'''
+        self.derive_calendar()
+        self.prune_orphans()
+        replaced_trips = self.derive_frequencies() if frequencies else set()
+        if transfers:
+            self.transfers = TransferBuilder(self).build()
+        trips = {trip_id: trip for trip_id, trip in self.trips.items() if not trip_id in replaced_trips}
+        checker = FeedChecker(self, gtfsfolder+'/validation_report.json', strict)
         
         self._write_csvfile(gtfsfolder, 'agency.txt', self.agencies, self.agencies_fields)
         self._write_csvfile(gtfsfolder, 'feed_info.txt', self.feed_info, self.feed_info_fields)
-        self._write_csvfile(gtfsfolder, 'routes.txt', self.routes, self.route_fields)
-        self._write_csvfile(gtfsfolder, 'trips.txt', self.trips, self.trip_fields)
+        self._write_csvfile(gtfsfolder, 'routes.txt', self.routes, self.route_fields, checker.check_route)
+        self._write_csvfile(gtfsfolder, 'trips.txt', trips, self.trip_fields, checker.check_trip)
         self._write_csvfile(gtfsfolder, 'calendar.txt', self.calendar, self.calendar_fields)
         self._write_csvfile(gtfsfolder, 'calendar_dates.txt', self.calendar_dates, self.calendar_dates_fields)
-        self._write_csvfile(gtfsfolder, 'stops.txt', self.stops, self.stop_fields)
-        self._write_csvfile(gtfsfolder, 'stop_times.txt', self.stop_times, self.stop_time_fields)
-        self._zip_files(gtfszip_filename, gtfsfolder)
-    
-    def _zip_files(self, gtfszip_filename, gtfsfolder):
+        self._write_csvfile(gtfsfolder, 'stops.txt', self.stops, self.stop_fields, checker.check_stop)
+        self._write_csvfile(gtfsfolder, 'stop_times.txt', self._stop_time_rows(replaced_trips), self.stop_time_fields, checker.check_stop_time)
         gtfsfiles = ['agency.txt', 'feed_info.txt', 'routes.txt', 'trips.txt', 
                 'calendar.txt', 
                 'calendar_dates.txt', 
                 'stops.txt', 'stop_times.txt']
+        if frequencies:
+            self._write_csvfile(gtfsfolder, 'frequencies.txt', self.frequencies, self.frequencies_fields)
+            gtfsfiles.append('frequencies.txt')
+        if transfers:
+            self._write_csvfile(gtfsfolder, 'transfers.txt', self.transfers, self.transfers_fields, checker.check_transfer)
+            gtfsfiles.append('transfers.txt')
+        checker.finish()
+        self._zip_files(gtfszip_filename, gtfsfolder, gtfsfiles)
+        
+        if sqlite_filename:
+            tables = [
+                ('agency', self.agencies, self.agencies_fields),
+                ('feed_info', self.feed_info, self.feed_info_fields),
+                ('routes', self.routes, self.route_fields),
+                ('trips', trips, self.trip_fields),
+                ('calendar', self.calendar, self.calendar_fields),
+                ('calendar_dates', self.calendar_dates, self.calendar_dates_fields),
+                ('stops', self.stops, self.stop_fields),
+                ('stop_times', self._stop_time_rows(replaced_trips), self.stop_time_fields)]
+            if frequencies:
+                tables.append(('frequencies', self.frequencies, self.frequencies_fields))
+            if transfers:
+                tables.append(('transfers', self.transfers, self.transfers_fields))
+            self._write_sqlite(sqlite_filename, tables)
+    
+    def _zip_files(self, gtfszip_filename, gtfsfolder, gtfsfiles):
         with ZipFile(gtfszip_filename, 'w', compression=ZIP_DEFLATED) as gtfszip:
             for gtfsfile in gtfsfiles:
                 gtfszip.write(gtfsfolder+'/'+gtfsfile, gtfsfile)
   
-    def _write_csvfile(self, gtfsfolder, filename, content, headers):
+    def _write_sqlite(self, sqlite_filename, tables):
+        '''Writes TABLES, a list of (table name, content, headers), into a new sqlite database
+        in a single transaction. Indexes are created after all rows are inserted.'''
+        if os.path.exists(sqlite_filename):
+            os.remove(sqlite_filename)
+        db = sqlite3.connect(sqlite_filename)
+        try:
+            with db:
+                for (table, content, headers) in tables:
+                    fieldnames = headers.split(',')
+                    db.execute('CREATE TABLE {} ({})'.format(table, ', '.join(fieldnames)))
+                    entities = content.values() if isinstance(content, dict) else content
+                    db.executemany('INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * len(fieldnames))),
+                        # stops may lack the optional trailing columns
+                        (list(entity) + [''] * (len(fieldnames) - len(entity)) for entity in entities))
+                table_names = [table for (table, content, headers) in tables]
+                for (table, column) in self.sqlite_indexes:
+                    if table in table_names:
+                        db.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(table, column))
+        finally:
+            db.close()
+    
+    def _write_csvfile(self, gtfsfolder, filename, content, headers, check = None):
         with open(gtfsfolder+"/"+filename, 'w', newline="\n", encoding="utf-8") as csvfile:
-            self._write_csv(csvfile, content, headers)
+            self._write_csv(csvfile, content, headers, check)
     
-    def _write_csv(self, csvfile, content, headers):
+    def _write_csv(self, csvfile, content, headers, check = None):
+        '''Writes content as csv. If provided, CHECK is called for every entity.'''
         fieldnames = headers.split(',')
         writer = csv.DictWriter(csvfile, fieldnames)
         writer.writeheader()
-        if isinstance(content, list):
-            for entity in content:
-                writer.writerow(dict(zip(fieldnames,entity)))
+        if isinstance(content, dict):
+            entities = (content[key] for key in sorted(content))
         else:
-            for key in sorted(content):
-                entity = content[key]
-                writer.writerow(dict(zip(fieldnames,entity)))
-    
-    def filter_unused_stops(self):
-        used_stops = {}
-        for stop_time in self.stop_times.values():
-            stopID = stop_time[4].strip()
-            if stopID in self.stops:
-                used_stops[stopID] = self.stops[stopID]    
-            else: 
-                print('Stop ', stopID,' used, but not stored', len(stopID))
-        self.stops = used_stops
+            entities = content
+        for entity in entities:
+            if check:
+                check(entity)
+            writer.writerow(dict(zip(fieldnames,entity)))
+    
+    def prune_orphans(self):
+        '''Removes stop_times of unknown trips, trips without stop_times, routes without trips, 
+        agencies without routes, stops without stop_times and transfers between removed stops
+        and reports references to missing entities. As reference counts are maintained while caching, this needs
+        no pass over all stop_times.'''
+        for trip_id in [trip_id for trip_id in self.trip_patterns if not trip_id in self.trips]:
+            print('WARN: stop_times of trip {} dropped, as trip is not stored'.format(trip_id))
+            self._reference_pattern(self.trip_patterns.pop(trip_id)[0], -1)
+        
+        pruned_trips = [trip_id for trip_id in self.trips if not trip_id in self.trip_patterns]
+        for trip_id in pruned_trips:
+            self.route_refs[self.trips.pop(trip_id)[self.TRIP_ROUTE_ID_IDX]] -= 1
+        
+        pruned_routes = [route_id for route_id in self.routes if self.route_refs[route_id] <= 0]
+        for route_id in pruned_routes:
+            self.agency_refs[self.routes.pop(route_id)[self.ROUTE_AGENCY_ID_IDX]] -= 1
+        
+        pruned_agencies = [agency_id for agency_id in self.agencies if self.agency_refs[agency_id] <= 0]
+        for agency_id in pruned_agencies:
+            del self.agencies[agency_id]
+        
+        pruned_stops = [stop_id for stop_id, stop in self.stops.items() if self.stop_refs[stop_id] <= 0 and not self._is_station(stop)]
+        for stop_id in pruned_stops:
+            del self.stops[stop_id]
+        parent_stations = Counter(self._parent_station(stop) for stop in self.stops.values())
+        pruned_stations = [stop_id for stop_id, stop in self.stops.items() if self._is_station(stop) and parent_stations[stop_id] == 0]
+        for stop_id in pruned_stations:
+            del self.stops[stop_id]
+        pruned_stops += pruned_stations
+        self.transfers = [transfer for transfer in self.transfers if transfer[0] in self.stops and transfer[1] in self.stops]
+        
+        print('Pruned {} trips, {} routes, {} agencies and {} stops without references'.format(
+            len(pruned_trips), len(pruned_routes), len(pruned_agencies), len(pruned_stops)))
+        
+        self._report_missing('Stop', self.stop_refs, self.stops)
+        self._report_missing('Route', self.route_refs, self.routes)
+        self._report_missing('Agency', self.agency_refs, self.agencies)
+        del parent_stations['']
+        self._report_missing('Parent station', parent_stations, self.stops)
+    
+    def _report_missing(self, entity_name, refs, entity_store):
+        for entity_id, count in refs.items():
+            if count > 0 and not entity_id in entity_store:
+                print('WARN: {} {} used {} times, but not stored'.format(entity_name, entity_id, count))
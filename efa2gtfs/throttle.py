@@ -0,0 +1,99 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+class AdaptiveThrottle():
+    '''Paces requests and adapts the request rate (requests per second) via additive increase/
+    multiplicative decrease: while responses are successful and faster than target_latency, 
+    the rate is increased by rate_increase, otherwise it is multiplied by rate_decrease.'''
+
+    def __init__(self, initial_rate, min_rate = 0.1, max_rate = 10, target_latency = 2.0, 
+            rate_increase = 0.1, rate_decrease = 0.5, clock = time.monotonic, sleep = time.sleep):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.rate_increase = rate_increase
+        self.rate_decrease = rate_decrease
+        self._rate = min(max(initial_rate, min_rate), max_rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._last_request = None
+        self._not_before = None
+
+    @property
+    def current_rate(self):
+        return self._rate
+
+    def wait(self):
+        '''Blocks until the next request may be sent according to the current rate.'''
+        now = self._clock()
+        if self._last_request is not None:
+            delay = self._last_request + 1.0 / self._rate - now
+            if self._not_before is not None:
+                delay = max(delay, self._not_before - now)
+            if delay > 0:
+                self._sleep(delay)
+                now += delay
+        self._last_request = now
+
+    def defer(self, seconds):
+        '''Delays the next request by at least SECONDS, e.g. as requested by a server's Retry-After.'''
+        self._not_before = self._clock() + seconds
+
+    def record(self, latency, success):
+        if success and latency <= self.target_latency:
+            self._rate = min(self._rate + self.rate_increase, self.max_rate)
+        else:
+            self._rate = max(self._rate * self.rate_decrease, self.min_rate)
+
+class CircuitBreaker():
+    '''Opens after failure_threshold consecutive failures and pauses requests for 
+    cooldown seconds. Afterwards, a single trial request is let through (half open): 
+    if it succeeds, the breaker closes again, otherwise it reopens.'''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold = 5, cooldown = 60, clock = time.monotonic, sleep = time.sleep):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._clock = clock
+        self._sleep = sleep
+
+    def wait_until_closed(self):
+        '''Blocks while the breaker is open.'''
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self.cooldown - self._clock()
+            if remaining > 0:
+                print("Circuit breaker open, pausing requests for {:.0f}s".format(remaining))
+                self._sleep(remaining)
+            self.state = self.HALF_OPEN
+
+    def record(self, success):
+        if success:
+            self._failures = 0
+            self.state = self.CLOSED
+        else:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = self._clock()
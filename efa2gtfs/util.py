@@ -16,6 +16,18 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import math
+
+EARTH_RADIUS = 6371000.0
+
+def distance(lat1, lon1, lat2, lon2):
+    '''Returns the haversine distance in meters between two WGS84 coordinates.'''
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
 def lpad(value, fill_char, length):
     pad = fill_char * (length - len(value))
     return pad + value
@@ -26,6 +38,25 @@ def convert_to_gtfs_time(hour_str, minute_str, start_hour_int = None):
         hour_int += 24
     return lpad(str(hour_int), '0', 2) + ':' + lpad(minute_str, '0', 2)
 
+def gtfs_time_to_seconds(gtfs_time):
+    '''Converts a HH:MM:SS gtfs time into seconds since start of service day.
+    Returns None for empty times.'''
+    if not gtfs_time:
+        return None
+    (hours, minutes, seconds) = gtfs_time.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+def seconds_to_gtfs_time(seconds):
+    if seconds is None:
+        return ''
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def delay_in_seconds(delay_minutes):
+    '''Converts an efa delay in minutes into seconds. Efa reports -1 if no realtime data is available.'''
+    if delay_minutes is None or str(delay_minutes) == '-1':
+        return None
+    return int(delay_minutes) * 60
+
 def as_array(node, key):
     value = node[key]
     if isinstance(value, list):
@@ -0,0 +1,185 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+from collections import Counter
+from efa2gtfs import util
+
+class FeedValidationError(Exception):
+    pass
+
+class FeedChecker():
+    '''Checks gtfs rows while they are exported: references to existing entities,
+    monotonic stop_sequences and times per trip, plausible speeds between consecutive
+    stops and duplicate trips. stop_times are expected to be grouped by trip, so only
+    the current trip's rows are kept in memory. Results are written as json report.'''
+
+    # max plausible speeds in km/h by extended route_type, rail (1xx) and others
+    max_rail_speed = 300
+    max_speed = 150
+    # number of examples reported per issue
+    max_examples = 20
+
+    def __init__(self, gtfs_store, report_filename, strict = False, max_errors = 1000):
+        '''If STRICT, a FeedValidationError is raised if any error was found, or as soon
+        as MAX_ERRORS errors were found.'''
+        self.gtfs_store = gtfs_store
+        self.report_filename = report_filename
+        self.strict = strict
+        self.max_errors = max_errors
+        self.errors = Counter()
+        self.warnings = Counter()
+        self.examples = {}
+        self._trip_signatures = set()
+        self._trip_id = None
+        self._trip_stop_times = []
+
+    def _record(self, issues, issue, entity_id, message):
+        issues[issue] += 1
+        examples = self.examples.setdefault(issue, [])
+        if len(examples) < self.max_examples:
+            examples.append({'id': entity_id, 'message': message})
+        if self.strict and sum(self.errors.values()) >= self.max_errors:
+            self.write_report()
+            raise FeedValidationError("Aborted export after {} errors, see {}".format(self.max_errors, self.report_filename))
+
+    def error(self, issue, entity_id, message):
+        self._record(self.errors, issue, entity_id, message)
+
+    def warn(self, issue, entity_id, message):
+        self._record(self.warnings, issue, entity_id, message)
+
+    def check_route(self, route):
+        agency_id = route[self.gtfs_store.ROUTE_AGENCY_ID_IDX]
+        if not agency_id in self.gtfs_store.agencies:
+            self.error('route_unknown_agency', route[0], 'agency {} does not exist'.format(agency_id))
+
+    def check_trip(self, trip):
+        route_id = trip[self.gtfs_store.TRIP_ROUTE_ID_IDX]
+        service_id = trip[self.gtfs_store.TRIP_SERVICE_ID_IDX]
+        if not route_id in self.gtfs_store.routes:
+            self.error('trip_unknown_route', trip[0], 'route {} does not exist'.format(route_id))
+        if not service_id in self.gtfs_store.calendar:
+            self.error('trip_unknown_service', trip[0], 'service {} does not exist'.format(service_id))
+
+    def check_stop(self, stop):
+        try:
+            lat = float(stop[self.gtfs_store.STOP_LAT_IDX])
+            lon = float(stop[self.gtfs_store.STOP_LON_IDX])
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                self.error('stop_invalid_coords', stop[0], 'coordinates ({}, {}) out of range'.format(lat, lon))
+        except ValueError:
+            self.error('stop_missing_coords', stop[0], 'no coordinates')
+
+    def check_transfer(self, transfer):
+        for stop_id in transfer[:2]:
+            if not stop_id in self.gtfs_store.stops:
+                self.error('transfer_unknown_stop', '{}-{}'.format(*transfer[:2]), 'stop {} does not exist'.format(stop_id))
+
+    def check_stop_time(self, stop_time):
+        trip_id = stop_time[self.gtfs_store.STOP_TIME_TRIP_ID_IDX]
+        if trip_id != self._trip_id:
+            self._finish_trip()
+            self._trip_id = trip_id
+            if not trip_id in self.gtfs_store.trips:
+                self.error('stop_time_unknown_trip', trip_id, 'trip does not exist')
+        stop_id = stop_time[self.gtfs_store.STOP_TIME_STOP_ID_IDX]
+        if not stop_id in self.gtfs_store.stops:
+            self.error('stop_time_unknown_stop', trip_id, 'stop {} does not exist'.format(stop_id))
+        self._trip_stop_times.append((
+            stop_time[self.gtfs_store.STOP_TIME_SEQ_NR],
+            stop_id,
+            util.gtfs_time_to_seconds(stop_time[2]),
+            util.gtfs_time_to_seconds(stop_time[3])))
+
+    def _finish_trip(self):
+        '''Checks the stop_times of the current trip.'''
+        stop_times = self._trip_stop_times
+        if not stop_times:
+            return
+        trip_id = self._trip_id
+        if stop_times[0][3] is None or stop_times[-1][2] is None:
+            self.error('trip_missing_terminal_times', trip_id, 'first departure or last arrival time missing')
+
+        previous = None
+        for stop_time in stop_times:
+            (seq, stop_id, arrival, departure) = stop_time
+            if arrival is not None and departure is not None and departure < arrival:
+                self.error('stop_time_departure_before_arrival', trip_id, 'departure before arrival at stop_sequence {}'.format(seq))
+            if previous:
+                if seq <= previous[0]:
+                    self.error('stop_time_sequence_not_increasing', trip_id, 'stop_sequence {} follows {}'.format(seq, previous[0]))
+                if arrival is not None and previous[3] is not None:
+                    if arrival < previous[3]:
+                        self.error('stop_time_travels_back_in_time', trip_id, 'arrival at stop_sequence {} before previous departure'.format(seq))
+                    else:
+                        self._check_speed(trip_id, previous, stop_time)
+            if departure is not None:
+                previous = stop_time
+
+        trip = self.gtfs_store.trips.get(trip_id)
+        if trip:
+            signature = (trip[self.gtfs_store.TRIP_ROUTE_ID_IDX], trip[self.gtfs_store.TRIP_SERVICE_ID_IDX],
+                hash(tuple((stop_id, arrival, departure) for (seq, stop_id, arrival, departure) in stop_times)))
+            if signature in self._trip_signatures:
+                self.warn('duplicate_trip', trip_id, 'trip with same route, service and stop_times already exported')
+            else:
+                self._trip_signatures.add(signature)
+        self._trip_stop_times = []
+
+    def _max_speed(self, trip_id):
+        trip = self.gtfs_store.trips.get(trip_id)
+        route = self.gtfs_store.routes.get(trip[self.gtfs_store.TRIP_ROUTE_ID_IDX]) if trip else None
+        route_type = str(route[self.gtfs_store.ROUTE_TYPE_IDX]) if route else ''
+        if len(route_type) == 3 and route_type.startswith('1'):
+            return self.max_rail_speed
+        return self.max_speed
+
+    def _check_speed(self, trip_id, previous, stop_time):
+        from_stop = self.gtfs_store.stops.get(previous[1])
+        to_stop = self.gtfs_store.stops.get(stop_time[1])
+        try:
+            distance = util.distance(
+                float(from_stop[self.gtfs_store.STOP_LAT_IDX]), float(from_stop[self.gtfs_store.STOP_LON_IDX]),
+                float(to_stop[self.gtfs_store.STOP_LAT_IDX]), float(to_stop[self.gtfs_store.STOP_LON_IDX]))
+        except (TypeError, ValueError):
+            return
+        # times have minute precision, so we assume at least a minute between stops
+        seconds = max(stop_time[2] - previous[3], 60)
+        speed = distance / seconds * 3.6
+        if speed > self._max_speed(trip_id):
+            self.warn('implausible_speed', trip_id, '{:.0f} km/h between {} and {}'.format(speed, previous[1], stop_time[1]))
+
+    def finish(self):
+        '''Checks the last trip and writes the report. If STRICT and errors were found,
+        raises a FeedValidationError.'''
+        self._finish_trip()
+        self._trip_id = None
+        self.write_report()
+        error_count = sum(self.errors.values())
+        print('Validation found {} errors and {} warnings, see {}'.format(error_count, sum(self.warnings.values()), self.report_filename))
+        if self.strict and error_count > 0:
+            raise FeedValidationError("Feed has {} errors, see {}".format(error_count, self.report_filename))
+
+    def write_report(self):
+        with open(self.report_filename, 'w', encoding='utf-8') as report_file:
+            json.dump({
+                'errors': self.errors,
+                'warnings': self.warnings,
+                'examples': self.examples,
+            }, report_file, indent = 2, sort_keys = True)
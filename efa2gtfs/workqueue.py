@@ -0,0 +1,140 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime, sqlite3, time
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+class LeaseLostError(Exception):
+    pass
+
+class CrawlWorkQueue():
+    '''Work queue of (stop_id, time window) units stored in a SQLite file, from which
+    several crawler workers (on one host or sharing the file) lease units. A lease
+    expires after lease_seconds unless renewed, so units of crashed workers are handed
+    out again. Units may be restricted to an efa instance (a config.ini section).'''
+
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, db_filename, lease_seconds = 600, max_attempts = 3, clock = time.time):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._clock = clock
+        # autocommit mode, transactions are started explicitly
+        self._db = sqlite3.connect(db_filename, timeout = 60, isolation_level = None)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS units (
+            unit_id INTEGER PRIMARY KEY,
+            stop_id TEXT NOT NULL,
+            window_start TEXT NOT NULL,
+            window_end TEXT NOT NULL,
+            instance TEXT NOT NULL,
+            status TEXT NOT NULL,
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            leased_at REAL,
+            completed_at REAL,
+            priority REAL NOT NULL DEFAULT 0,
+            UNIQUE (stop_id, window_start, window_end, instance))''')
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(units)')]
+        if not 'priority' in columns:
+            # queue files created before units had priorities
+            self._db.execute('ALTER TABLE units ADD COLUMN priority REAL NOT NULL DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS units_status ON units (instance, status, lease_expires)')
+
+    def enqueue(self, stop_ids, start_datetime, end_datetime, instance = 'default', priorities = None):
+        '''Adds a unit per stop_id for the window START_DATETIME to END_DATETIME.
+        Units are leased by descending priority, which may be provided per stop_id
+        via PRIORITIES (e.g. the estimated crawl cost, see scheduler.CrawlScheduler).
+        Already existing units are left untouched. Returns the number of added units.'''
+        priorities = priorities or {}
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            before = self._db.total_changes
+            self._db.executemany('''INSERT OR IGNORE INTO units (stop_id, window_start, window_end, instance, status, priority)
+                VALUES (?, ?, ?, ?, ?, ?)''',
+                ((str(stop_id), start_datetime.strftime(DATETIME_FORMAT), end_datetime.strftime(DATETIME_FORMAT), instance, self.PENDING, 
+                    priorities.get(stop_id, 0)) for stop_id in stop_ids))
+            added = self._db.total_changes - before
+            self._db.execute('COMMIT')
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        return added
+
+    def lease(self, worker, instance = 'default'):
+        '''Leases the next pending (or expired) unit to WORKER. Returns a tuple
+        (unit_id, stop_id, window_start, window_end) or None, if no unit is available.'''
+        now = self._clock()
+        # BEGIN IMMEDIATE acquires the write lock, so no two workers lease the same unit
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            # expired leases of units which had their last attempt are given up
+            self._db.execute('UPDATE units SET status = ? WHERE instance = ? AND status = ? AND lease_expires < ? AND attempts >= ?',
+                (self.FAILED, instance, self.LEASED, now, self.max_attempts))
+            row = self._db.execute('''SELECT unit_id, stop_id, window_start, window_end FROM units
+                WHERE instance = ? AND (status = ? OR (status = ? AND lease_expires < ?))
+                ORDER BY priority DESC, unit_id LIMIT 1''', (instance, self.PENDING, self.LEASED, now)).fetchone()
+            if row:
+                self._db.execute('''UPDATE units SET status = ?, worker = ?, lease_expires = ?,
+                    attempts = attempts + 1, leased_at = ? WHERE unit_id = ?''',
+                    (self.LEASED, worker, now + self.lease_seconds, now, row[0]))
+            self._db.execute('COMMIT')
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return (row[0], row[1], datetime.datetime.strptime(row[2], DATETIME_FORMAT), datetime.datetime.strptime(row[3], DATETIME_FORMAT))
+
+    def renew(self, unit_id, worker):
+        '''Extends the lease of UNIT_ID. Returns False, if the lease was lost to another worker.'''
+        cursor = self._db.execute('UPDATE units SET lease_expires = ? WHERE unit_id = ? AND worker = ? AND status = ?',
+            (self._clock() + self.lease_seconds, unit_id, worker, self.LEASED))
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, worker):
+        self._db.execute('UPDATE units SET status = ?, completed_at = ? WHERE unit_id = ? AND worker = ?',
+            (self.DONE, self._clock(), unit_id, worker))
+
+    def fail(self, unit_id, worker):
+        '''Releases UNIT_ID for another attempt or marks it as failed after max_attempts.'''
+        self._db.execute('''UPDATE units SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+            lease_expires = NULL WHERE unit_id = ? AND worker = ?''',
+            (self.max_attempts, self.FAILED, self.PENDING, unit_id, worker))
+
+    def counts(self, instance = 'default'):
+        '''Returns the number of units per status.'''
+        return dict(self._db.execute('SELECT status, count(*) FROM units WHERE instance = ? GROUP BY status', (instance,)).fetchall())
+
+    def timings(self, instance = 'default'):
+        '''Returns (makespan, total_work, workers) of the completed units: the seconds from
+        the first lease to the last completion, the sum of the units' crawl seconds and
+        the number of workers which completed units.'''
+        (first_leased, last_completed, total_work, workers) = self._db.execute('''SELECT min(leased_at), max(completed_at),
+            sum(completed_at - leased_at), count(DISTINCT worker) FROM units WHERE instance = ? AND status = ?''',
+            (instance, self.DONE)).fetchone()
+        if first_leased is None:
+            return (0, 0, 0)
+        return (last_completed - first_leased, total_work, workers)
+
+    def close(self):
+        self._db.close()
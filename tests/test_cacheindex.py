@@ -0,0 +1,54 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib, glob, io, os, shutil, tempfile, unittest
+from unittest import mock
+
+from efa2gtfs import cacheindex, converter
+
+EXAMPLE_CACHE = os.path.join(os.path.dirname(__file__), '..', 'examples', 'efa_files_cache')
+
+class ReadOnlyCacheTest(unittest.TestCase):
+    '''Checks that a filtered import of a cache without sidecars works, even if 
+    sidecars can't be written.'''
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        for filename in glob.glob(os.path.join(EXAMPLE_CACHE, '*.json')):
+            shutil.copy(filename, self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_filtered_import_without_writable_sidecars(self):
+        e2g = converter.Converter()
+        cache_filter = cacheindex.CacheFilter(networks = ['vsh'])
+        with mock.patch('efa2gtfs.cacheindex.write_metadata', side_effect = PermissionError('read-only')):
+            with contextlib.redirect_stdout(io.StringIO()):
+                e2g.import_from_dir(self.cache_dir, ['vvs'], cache_filter)
+        self.assertTrue(e2g.gtfs_store.trips)
+        self.assertFalse(glob.glob(os.path.join(self.cache_dir, '*' + cacheindex.METADATA_SUFFIX)))
+
+    def test_missing_sidecar_is_written(self):
+        (filename,) = glob.glob(os.path.join(self.cache_dir, '*.json'))
+        metadata = cacheindex.read_metadata(filename)
+        self.assertTrue(os.path.exists(cacheindex.metadata_filename(filename)))
+        self.assertEqual(cacheindex.read_metadata(filename), metadata)
+
+if __name__ == '__main__':
+    unittest.main()
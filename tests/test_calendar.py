@@ -0,0 +1,92 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib, csv, datetime, io, os, tempfile, unittest
+
+from efa2gtfs import converter
+from efa2gtfs.calendar import ServiceCalendar
+
+EXAMPLE_CACHE = os.path.join(os.path.dirname(__file__), '..', 'examples', 'efa_files_cache')
+
+def days(start, count):
+    return [start + datetime.timedelta(days=offset) for offset in range(count)]
+
+class ServiceCalendarTest(unittest.TestCase):
+    '''Checks the calendar and calendar_dates rows derived from observed service dates.'''
+
+    # a monday
+    monday = datetime.date(2018, 4, 2)
+
+    def test_trips_with_same_days_share_service_id(self):
+        calendar = ServiceCalendar()
+        for trip_id in ('weekday_1', 'weekday_2'):
+            for date in days(self.monday, 5):
+                calendar.add(trip_id, date)
+        calendar.add('sunday', self.monday + datetime.timedelta(days=6))
+        (service_ids, rows, calendar_dates) = calendar.derive()
+        self.assertEqual(service_ids['weekday_1'], service_ids['weekday_2'])
+        self.assertNotEqual(service_ids['weekday_1'], service_ids['sunday'])
+        self.assertEqual(rows[service_ids['weekday_1']], [service_ids['weekday_1'], '20180402', '20180408', 1, 1, 1, 1, 1, 0, 0])
+        self.assertEqual(rows[service_ids['sunday']], [service_ids['sunday'], '20180402', '20180408', 0, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(calendar_dates, [])
+
+    def test_deviating_days_become_calendar_dates(self):
+        calendar = ServiceCalendar((self.monday, self.monday + datetime.timedelta(days=20)))
+        for date in days(self.monday, 21):
+            if date.weekday() < 6 and date != datetime.date(2018, 4, 4):
+                calendar.add('trip', date)
+        (service_ids, rows, calendar_dates) = calendar.derive()
+        service_id = service_ids['trip']
+        self.assertEqual(rows[service_id][3:], [1, 1, 1, 1, 1, 1, 0])
+        self.assertEqual(calendar_dates, [['20180404', service_id, '2']])
+
+    def test_dates_are_added_before_epoch(self):
+        calendar = ServiceCalendar()
+        calendar.add('trip', self.monday + datetime.timedelta(days=1))
+        calendar.add('trip', self.monday)
+        self.assertEqual(calendar.service_dates('trip'), days(self.monday, 2))
+        self.assertEqual(calendar.period, (self.monday, self.monday + datetime.timedelta(days=1)))
+
+    def test_trips_outside_service_period_get_no_service_id(self):
+        calendar = ServiceCalendar((self.monday, self.monday + datetime.timedelta(days=6)))
+        calendar.add('inside', self.monday)
+        calendar.add('outside', self.monday + datetime.timedelta(days=7))
+        (service_ids, rows, calendar_dates) = calendar.derive()
+        self.assertEqual(list(service_ids), ['inside'])
+        self.assertEqual(len(rows), 1)
+
+class RepeatedImportTest(unittest.TestCase):
+    '''Checks that importing several directories into the same converter keeps 
+    the service dates of earlier imports.'''
+
+    def test_second_import_keeps_service_dates(self):
+        e2g = converter.Converter()
+        with tempfile.TemporaryDirectory() as out_dir, tempfile.TemporaryDirectory() as empty_dir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                e2g.import_from_dir(EXAMPLE_CACHE, ['vvs'])
+                trip_count = len(e2g.gtfs_store.trips)
+                e2g.import_from_dir(empty_dir)
+                e2g.export_gtfs(os.path.join(out_dir, 'gtfs.zip'), os.path.join(out_dir, 'gtfs'))
+            with open(os.path.join(out_dir, 'gtfs', 'trips.txt'), encoding='utf-8', newline='') as trips_file:
+                trips = list(csv.DictReader(trips_file))
+        self.assertTrue(trip_count)
+        self.assertEqual(len(trips), trip_count)
+        self.assertTrue(all(trip['service_id'] for trip in trips))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib, copy, glob, io, itertools, json, os, unittest
+
+from efa2gtfs import converter, efa
+
+EXAMPLE_CACHE = os.path.join(os.path.dirname(__file__), '..', 'examples', 'efa_files_cache')
+
+def strip_point_gids(dm_response):
+    '''Returns a copy of DM_RESPONSE, where every other prev/onward stop has neither
+    pointGid nor gid, so that its stop_id is not derived from a pointGid.'''
+    stripped = copy.deepcopy(dm_response)
+    for departure in stripped.get('departureList') or []:
+        for seq in ('prevStopSeq', 'onwardStopSeq'):
+            stops = departure.get(seq) or []
+            if isinstance(stops, dict):
+                stops = [stops]
+            for idx, stop in enumerate(stops):
+                if idx % 2 == 0:
+                    stop['ref'].pop('pointGid', None)
+                    stop['ref'].pop('gid', None)
+    return stripped
+
+class PointGidResolutionTest(unittest.TestCase):
+    '''Imports every example response twice, first without some pointGids, then 
+    unchanged, and checks the batched resolution against the first-match rule:
+    a stop_id which is no pointGid is replaced by the id of the first later 
+    sighting of the same stop which has a pointGid.'''
+
+    def setUp(self):
+        filenames = sorted(glob.glob(os.path.join(EXAMPLE_CACHE, '*.json')))
+        self.assertTrue(filenames)
+        responses = []
+        for filename in filenames:
+            with open(filename, encoding='utf-8') as response_file:
+                responses.append(json.load(response_file))
+        self.sightings = ([(strip_point_gids(response), filename) for response, filename in zip(responses, filenames)] +
+            list(zip(responses, filenames)))
+        self.converter = converter.Converter()
+        self.converter.prepare_import(['vvs'])
+
+    def test_batched_resolution_matches_first_match(self):
+        store = self.converter.gtfs_store
+        stop_id_idx = store.STOP_TIME_STOP_ID_IDX
+        expected = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for dm_response, filename in self.sightings:
+                resightings = [trip for trip in self.converter.filtered_trips(efa.DmResponse(dm_response)) 
+                    if store.is_stop_times_extracted(trip.trip_id)]
+                self.converter.extract_gtfs_info_from_json(dm_response, filename)
+                for trip in resightings:
+                    stop_times = expected.setdefault(trip.trip_id, store.trip_stop_times(trip.trip_id))
+                    self._apply_first_match(stop_times, trip, stop_id_idx)
+            unresolved = sum(len(store.unresolved_stop_ids(trip_id)) for trip_id in expected)
+            self.converter.resolve_point_gids()
+
+        self.assertTrue(unresolved, 'example has no stop_ids to resolve')
+        for trip_id, stop_times in expected.items():
+            self.assertEqual(store.trip_stop_times(trip_id), stop_times, trip_id)
+
+    def _apply_first_match(self, stop_times, trip, stop_id_idx):
+        for stop_time in stop_times:
+            if ':' in stop_time[stop_id_idx]:
+                continue
+            for trip_stop in itertools.chain(trip.prev_stops, trip.onward_stops):
+                if trip_stop.id == stop_time[stop_id_idx] and trip_stop.point_gid:
+                    stop_time[stop_id_idx] = self.converter.retrieve_stop_id(trip_stop)
+                    break
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#
+#    efa2gtfs
+#    Copyright (C) 2018  Holger Bruch <hb@mfdz.de>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib, datetime, glob, io, json, os, unittest
+
+from efa2gtfs import converter, efa
+
+EXAMPLE_CACHE = os.path.join(os.path.dirname(__file__), '..', 'examples', 'efa_files_cache')
+
+def next_day(dm_response):
+    '''Returns a copy of DM_RESPONSE, whose departures run one day later.'''
+    shifted = json.loads(json.dumps(dm_response).replace('"20180608 ', '"20180609 '))
+    for departure in shifted['departureList']:
+        departure['dateTime']['day'] = str(int(departure['dateTime']['day']) + 1)
+    return shifted
+
+def onward_stops(departure):
+    stops = departure.get('onwardStopSeq') or []
+    return stops if isinstance(stops, list) else [stops]
+
+class TripVariantTest(unittest.TestCase):
+    '''Imports the example response for two days, where one trip runs with different
+    times on the second day, and checks it is kept as separate trip.'''
+
+    def setUp(self):
+        filename = sorted(glob.glob(os.path.join(EXAMPLE_CACHE, '*.json')))[0]
+        with open(filename, encoding='utf-8') as response_file:
+            self.response = json.load(response_file)
+        self.converter = converter.Converter()
+        self.converter.prepare_import(['vvs'])
+
+    def test_trip_with_other_running_times_becomes_variant(self):
+        second_day = next_day(self.response)
+        departure = next(departure for departure in second_day['departureList'] if len(onward_stops(departure)) > 1)
+        last_stop = onward_stops(departure)[-1]['ref']
+        arrival = datetime.datetime.strptime(last_stop['arrDateTime'], '%Y%m%d %H:%M') + datetime.timedelta(minutes=2)
+        last_stop['arrDateTime'] = last_stop['depDateTime'] = arrival.strftime('%Y%m%d %H:%M')
+        efa_trip_id = efa.DmDeparture(departure).trip_id
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.converter.extract_gtfs_info_from_json(self.response, 'first_day.json')
+            self.converter.extract_gtfs_info_from_json(second_day, 'second_day.json')
+
+        store = self.converter.gtfs_store
+        calendar = store.service_calendar
+        variant_trip_id = efa_trip_id + '-2'
+        self.assertIn(variant_trip_id, store.trips)
+        self.assertEqual(calendar.service_dates(efa_trip_id), [datetime.date(2018, 6, 8)])
+        self.assertEqual(calendar.service_dates(variant_trip_id), [datetime.date(2018, 6, 9)])
+        self.assertEqual(store.trip_stop_times(variant_trip_id)[-1][3], arrival.strftime('%H:%M:00'))
+        self.assertNotEqual(store.trip_stop_times(efa_trip_id)[-1][3], store.trip_stop_times(variant_trip_id)[-1][3])
+        other_trip_ids = [trip_id for trip_id in store.trips if not trip_id in (efa_trip_id, variant_trip_id)]
+        self.assertTrue(other_trip_ids)
+        for trip_id in other_trip_ids:
+            self.assertEqual(calendar.service_dates(trip_id), [datetime.date(2018, 6, 8), datetime.date(2018, 6, 9)], trip_id)
+
+    def test_same_running_times_share_trip(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.converter.extract_gtfs_info_from_json(self.response, 'first_day.json')
+            self.converter.extract_gtfs_info_from_json(next_day(self.response), 'second_day.json')
+        self.assertFalse([trip_id for trip_id in self.converter.gtfs_store.trips if trip_id.endswith('-2')])
+
+if __name__ == '__main__':
+    unittest.main()